@@ -13,7 +13,10 @@ from auth import Auth
 from dotenv import load_dotenv, find_dotenv
 import requests
 import get_data_from_feishu
-from collections import deque
+import okr_objects
+import org_hierarchy
+import talk2Tidb
+import user_store
 import threading
 import logging
 from logging.handlers import RotatingFileHandler
@@ -86,154 +89,97 @@ rds = redis.Redis(host='127.0.0.1',
                   decode_responses=True,
                   charset='UTF-8',
                   encoding='UTF-8')
+# the users cache in redis, versioned, see user_store.py
+users_store = user_store.UserStore(rds)
+# the leadership hierarchy index of one version of the users cache, per process
+hierarchy_cache = {'version': None, 'hierarchy': None}
+hierarchy_lock = threading.Lock()
+# the parsed OKRs of the users, per process, see okr_objects.py
+okr_cache = okr_objects.OkrCache()
 # const
 pagesize = 20
 
 
 # internal functions, only called within this file, start with _
 
-def _get_leader(open_id):
-    return rds.hget(name=open_id, key='leader')
+def _user_key(open_id):
+    return users_store.key(open_id)
 
 
-def _get_direct_subordinates(leader):
+def _get_hierarchy():
     """
-    System build phase only
+    Return:
+        org_hierarchy.Hierarchy of the users cache version the readers are on.
+        It is rebuilt from the leaders kept in the version when another process has loaded a new one.
     """
-    direct_subs = []
+    version = users_store.current_version()
+    if hierarchy_cache['version'] != version:
+        with hierarchy_lock:
+            if hierarchy_cache['version'] != version:
+                leaders = json.loads(users_store.get_blob('leaders', version) or '[]')
+                hierarchy_cache['hierarchy'] = org_hierarchy.Hierarchy(leaders)
+                hierarchy_cache['version'] = version
+    return hierarchy_cache['hierarchy']
 
-    for sub in leader['sub']:
-        direct_subs.append(sub['id'])
 
-    return direct_subs
+def _parse_okr(okr_str):
+    try:
+        return okr_objects.parse_okr(okr_str)
+    except Exception as e:
+        my_app.logger.error('%s: okr_str is %s' % (e, okr_str))
+        return okr_objects.EMPTY_OKR
 
 
-def _get_subordinates(leader):
+def _get_okrs(cards):
     """
-    System build phase only
     Args:
-        leader, kv block
+        cards: dict, open_id => user card, see user_store.get_cards()
     Return:
-        list of ids
+        dict, open_id => okr_objects.Okr, each parsed once per process for each hashcode of the raw OKR.
+        The raw OKRs not parsed yet are read in one round trip
     """
-    subs = _get_direct_subordinates(leader)
-    for sub in leader['sub']:
-        subs.extend(_get_subordinates(sub))
-    return subs
+    okrs = {}
+    for open_id, card in cards.items():
+        okr = okr_cache.get(open_id, card['okr_hash'])
+        if okr is not None:
+            okrs[open_id] = okr
 
+    missing = [open_id for open_id in cards if open_id not in okrs]
+    for open_id, fields in users_store.get_fields(missing, ('okr', 'okr_hash')).items():
+        okrs[open_id] = okr_cache.put(open_id, fields['okr_hash'], _parse_okr(fields['okr']))
+    return okrs
 
-def _attach(user, leader):
-    """
-    Attach a user to a leader.
 
-    Both are user KV block mentioned in function build_leadership_forest
+def _get_okr(open_id):
     """
-    if user['id'] not in [u['id'] for u in leader['sub']]:
-        leader['sub'].append(user)
-
-
-def _in_forest(forest, leader_id):
-    """
-    Return the leader kv block if the leader is in the forest.
-    Otherwise return None
-    Precondition:
-    User must have leader
+    Return:
+        okr_objects.Okr of the user, empty if the user has gone
     """
+    return _get_okrs(users_store.get_cards([open_id])).get(open_id, okr_objects.EMPTY_OKR)
 
-    for root in forest:
-        q = deque()
-        q.append(root)
-        while q:
-            for _ in range(len(q)):  # extend in the end of for loop does not affect the loop times
-                node = q.popleft()
-                if node['id'] == leader_id:
-                    return node
-                q.extend(node['sub'])
 
-        return {}
-
-
-def _join_leaders_forest(forest, user):
-    """
-    Args:
-        forest, List of forest roots, element is top leader
-        user, user KV block to join
-    Return:
-        None. While forest will be update
-    """
-    leader_id = _get_leader(user['id'])
-    while leader_id:
-        leader = _in_forest(forest, leader_id)
-        if leader:
-            _attach(user, leader)
-            return
-        else:  # your leader is not in forest. create the leader
-            leader = {'id': leader_id, 'sub': []}
-            _attach(user, leader)
-            leader_id = _get_leader(leader_id)
-            user = leader
-
-    # user is the top level leader, create a new tree
-    forest.append(user)
-
-
-def _traverse_forest(forest):
-    for root in forest:
-        q = deque()
-        q.append(root)
-        while q:
-            for _ in range(len(q)):  # extend in the end of for loop does not affect the loop times
-                node = q.popleft()
-                yield node
-                q.extend(node['sub'])
-
-
-def _build_leadership_forest(users):
-    """
-    Args:
-        tup list of users
-    Return:
-        Return the roots List of the leadership forest
-    Precondition:
-        Users basic data has been put in Redis
-    Notice:
-        Each user will be expressed in key-value
-        {
-        "id": open_id,
-        "sub":[
-            {
-            "id":open_id,
-            "sub":[
-                {
-                }
-                ...
-                ]
-            }
-            ...
-            ]
-        }
-    """
-    forest = []
-    for user in users:
-        user_kv = {'id': user.open_id, 'sub': []}
-        _join_leaders_forest(forest, user_kv)
-    return forest
+def _get_name(open_id):
+    return users_store.get_card(open_id).get('name')
 
 
 def _is_subordinate(leader_open_id, open_id):
     """
     Return true if <open_id> is the subordinate of <leader_open_id>,
     otherwise return False
+    It is an interval check on the hierarchy index, see org_hierarchy.py
     """
     if open_id == '':
         return False
 
-    leader = _get_leader(open_id)
-    while leader:
-        if leader == leader_open_id:
-            return True
-        leader = _get_leader(leader)
-    return False
+    return _get_hierarchy().is_subordinate(leader_open_id, open_id)
+
+
+def _split_subordinates(leader_open_id, open_ids):
+    """
+    Return:
+        (List of the subordinates of <leader_open_id> in open_ids, List of the others)
+    """
+    return _get_hierarchy().split_subordinates(leader_open_id, open_ids)
 
 
 def get_search_display_similarites(open_id):
@@ -246,15 +192,19 @@ def get_search_display_similarites(open_id):
 
     search_str_list = json.loads(current_user.segs).keys()
 
-    for user_id in current_user.top_related.split(';'):
+    top_related = current_user.top_related.split(';')
+    cards = users_store.get_cards(top_related)
+    okrs = _get_okrs(cards)
+
+    for user_id in top_related:
+        card = cards.get(user_id)
+        if not card:  # it is possible the user has gone
+            continue
         sd = Searchdisplay()
-        sd.whose = rds.hget(name=user_id, key='name')
+        sd.whose = card['name']
         sd.who_id = user_id
-        sd.url = URL_BASE + rds.hget(name=user_id, key='url_id')
-        okr_str = rds.hget(name=user_id, key='okr')
-        okr_content, nil, nil = my_utils.get_okrcontent_from_okr_str(okr_str,
-                                                                     seg_list=search_str_list,
-                                                                     app=my_app)
+        sd.url = URL_BASE + card['url_id']
+        okr_content = okrs.get(user_id, okr_objects.EMPTY_OKR).content(search_str_list)
         beg_em_str = '<em style="color:red;">'
         end_em_str = '</em>'
         """
@@ -274,7 +224,7 @@ def get_search_display_similarites(open_id):
 
         sd.okr_content = okr_content
         sd.highly = ''
-        sd.avatar = rds.hget(name=user_id, key='avatar')
+        sd.avatar = card['avatar']
         display_list.append(sd)
     return display_list
 
@@ -298,31 +248,30 @@ def final_display_list(ordered_open_id_list,
         each element is an objective of Searchdisplay
     """
     display_list = []
-    touched = 0
 
-    for open_id in ordered_open_id_list:
-        touched += 1
-        if touched <= pagesize * page_no:  # skip the previous pages
-            continue
+    # the users of the page are read in one round trip, and their OKRs not parsed yet in another
+    first = pagesize * page_no  # skip the previous pages
+    page = ordered_open_id_list[first:first + pagesize]
+    cards = users_store.get_cards(page)
+    okrs = _get_okrs(cards)
+
+    # split it by any number of blank
+    search_str_list = re.split(r"[ ]+", search_str)
 
-        mentioning_user_name = rds.hget(name=open_id, key='name')
-        if not mentioning_user_name:  # it is possible the user has gone
+    for touched, open_id in enumerate(page, first + 1):
+        card = cards.get(open_id)
+        if not card or not card['name']:  # it is possible the user has gone
             continue
 
         sd = Searchdisplay()
 
-        sd.whose = rds.hget(name=open_id, key='name')
+        sd.whose = card['name']
 
         sd.who_id = open_id
 
-        sd.url = URL_BASE + rds.hget(name=open_id, key='url_id')
-
-        okr_str = rds.hget(name=open_id, key='okr')
+        sd.url = URL_BASE + card['url_id']
 
-        # split it by any number of blank
-        search_str_list = re.split(r"[ ]+", search_str)
-
-        okr_content, nil, nil = my_utils.get_okrcontent_from_okr_str(okr_str, search_str_list, my_app)
+        okr_content = okrs.get(open_id, okr_objects.EMPTY_OKR).content(search_str_list)
 
         if em:  # emphasize the key word in the okr_content, true by default.
             beg_em_str = '<em style="color:red;">'
@@ -340,12 +289,9 @@ def final_display_list(ordered_open_id_list,
         else:
             sd.highly = ''
 
-        sd.avatar = rds.hget(name=open_id, key='avatar')
+        sd.avatar = card['avatar']
 
         display_list.append(sd)
-
-        if touched - pagesize * page_no >= pagesize:
-            break
     return display_list
 
 
@@ -377,25 +323,50 @@ def load_users_tbl_to_redis():
     """
     load users table information to redis as cache.
     Also build up the leader tree
+    All the users are written into a new version of the cache in a few pipelined round trips,
+    the readers are switched to it at once, see user_store.py
     """
 
+    t1 = time.time()
     users = Users.query.all()
-    for user in users:
-        rds.hset(name=user.open_id, key='okr', value=user.okr)
-        rds.hset(name=user.open_id, key='name', value=user.name)
-        rds.hset(name=user.open_id, key='url_id', value=user.url_id)
-        rds.hset(name=user.open_id, key='email', value=user.email)
-        rds.hset(name=user.open_id, key='en_name', value=user.en_name)
-        rds.hset(name=user.open_id, key='leader', value=user.leader)
-        rds.hset(name=user.open_id, key='avatar', value=user.avatar)
-
-    forest = _build_leadership_forest(users)
-    iterator = _traverse_forest(forest)
 
-    for node in iterator:
-        if _get_direct_subordinates(node):
-            rds.hset(name=node['id'], key='direct_sub', value=';'.join(_get_direct_subordinates(node)))
-            rds.hset(name=node['id'], key='all_sub', value=';'.join(_get_subordinates(node)))
+    fields = {}
+    okrs = {}
+    for user in users:
+        okr_hash = okr_objects.okr_hashcode(user.okr)
+        okrs[user.open_id] = (okr_hash, user.okr)
+        fields[user.open_id] = {'okr': user.okr,
+                                'okr_hash': okr_hash,
+                                'name': user.name,
+                                'url_id': user.url_id,
+                                'email': user.email,
+                                'en_name': user.en_name,
+                                'leader': user.leader,
+                                'avatar': user.avatar}
+
+    # the leadership forest is built in one pass, see org_hierarchy.py
+    leaders = [(user.open_id, user.leader) for user in users]
+    hierarchy = org_hierarchy.Hierarchy(leaders)
+
+    for leader_id, (direct_subs, all_subs) in hierarchy.subordinates().items():
+        # a leader could be out of the users table, he/she still has the subordinates
+        user_fields = fields.setdefault(leader_id, {})
+        user_fields['direct_sub'] = ';'.join(direct_subs)
+        user_fields['all_sub'] = ';'.join(all_subs)
+
+    # the leaders are kept in the version too, so the other processes can build the same hierarchy index
+    count = users_store.load(fields.items(), blobs={'leaders': json.dumps(leaders)})
+    with hierarchy_lock:
+        hierarchy_cache['hierarchy'] = hierarchy
+        hierarchy_cache['version'] = users_store.current_version()
+    my_app.logger.debug('loaded %s users into redis version %s, used %.3f seconds'
+                        % (count, users_store.current_version(), time.time() - t1))
+
+    # parse the OKRs here, not in the requests. The other processes parse each one when it is first read
+    okr_cache.clear()
+    for open_id, (okr_hash, okr_str) in okrs.items():
+        okr_cache.put(open_id, okr_hash, _parse_okr(okr_str))
+    my_app.logger.debug('parsed %s OKRs, used %.3f seconds' % (len(okr_cache), time.time() - t1))
 
 
 def update_search_str_in_redis():
@@ -423,6 +394,22 @@ def update_search_str_in_redis():
     return 'success'
 
 
+def _get_seg_postings(seg):
+    """
+    Args:
+        seg: String, lowercase key word
+    Return:
+        dict, open_id => how many times the seg appears in the user's OKR, {} if nobody mentions it
+    """
+    if talk2Tidb.KEY2USER_STORAGE == 'posting':
+        return {p.open_id: p.num for p in Key2user_posting.query.filter_by(seg=seg).all()}
+
+    tup = Key2user.query.filter_by(seg=seg).first()
+    if tup and tup.open_id_list:
+        return json.loads(tup.open_id_list)  # change to a dict string after issue #1
+    return {}
+
+
 def get_ordered_open_id_list(search_str):
     """
     Args:
@@ -478,9 +465,8 @@ def get_ordered_open_id_list(search_str):
             # all keys in the key2user is lowercase to make case-insensitive
             search_item = search_item.lower()
 
-            tup = Key2user.query.filter_by(seg=search_item).first()
-            if tup:
-                open_id_dict = json.loads(tup.open_id_list)  # change to a dict string after issue #1
+            open_id_dict = _get_seg_postings(search_item)
+            if open_id_dict:
                 for open_id in open_id_dict.keys():
                     if open_id in temp_open_id_dict.keys():
                         temp_open_id_dict[open_id] += 1000 + open_id_dict[open_id]
@@ -671,7 +657,7 @@ def send_admin_message(adminID, who_id, what):
     <at user_id="ou_xxx">name</at> done something
     """
     msgContent = {
-        "text": "<at user_id=\"%s\">%s</at> %s" % (who_id, rds.hget(name=who_id, key='name'), what)
+        "text": "<at user_id=\"%s\">%s</at> %s" % (who_id, _get_name(who_id), what)
     }
 
     get_data_from_feishu.send_notify(my_app, adminID, msgContent, 'text')
@@ -839,10 +825,11 @@ def rebuild_sbscrb_notify():
             record.subs_date = datetime.datetime.today()
             db.session.commit()
 
+    cards = users_store.get_cards(notify_dict.keys())
     send_admin_message(DEBUG_USER_ID,
                        DEBUG_USER_ID,
                        'rebuild the system. %s'
-                       % ' '.join([rds.hget(name=open_id, key='name')
+                       % ' '.join([cards.get(open_id, {}).get('name') or ''
                                    for open_id in notify_dict.keys()]) if notify_dict else '')
 
 
@@ -864,8 +851,16 @@ def get_departments_health_info(parent):
 
     tup_list = Departments.query.filter_by(parent_dep_id=parent).all()
 
+    # the leaders and the not healthy users of all the departments are read in one round trip
+    open_ids = []
+    for tup in tup_list:
+        open_ids.append(tup.leader)
+        if tup.not_health_user:
+            open_ids.extend(tup.not_health_user.split(';'))
+    cards = users_store.get_cards(open_ids)
+
     for tup in tup_list:
-        leader_name = rds.hget(name=tup.leader, key='name')
+        leader_name = cards.get(tup.leader, {}).get('name')
         depart = [
             tup.name,
             leader_name,
@@ -874,106 +869,55 @@ def get_departments_health_info(parent):
             float('%.1f' % (int(tup.avail_okr_count) / int(tup.member_count) * 100)),
             [
                 [
-                    rds.hget(name=u, key='name'),
-                    URL_BASE + rds.hget(name=u, key='url_id'),
-                    rds.hget(name=u, key='avatar')
-                ] for u in tup.not_health_user.split(';')
+                    cards[u]['name'],
+                    URL_BASE + cards[u]['url_id'],
+                    cards[u]['avatar']
+                ] for u in tup.not_health_user.split(';') if u in cards
             ] if tup.not_health_user else []
         ]
         departs.append(depart)
     return departs
 
 
-def get_obj_list_from_okr_str(okr_str):
-    """
-    Args:
-        okr_str: String, transferred from okr dict
-        Return:
-            obj list
-            Reference:
-            https://open.feishu.cn/document/uAjLw4CM/ukTMukTMukTM/reference/okr-v1/user-okr/list
-    """
-
-    if not okr_str:
-        return []
-
-    try:
-        data = json.loads(okr_str, strict=False)
-    except Exception as e:
-        my_app.logger.error(e)
-
-    return data['objective_list']
-
-
 def get_obj_by_obj_id(open_id, obj_id):
     """
     Arguments:
         open_id, String User
         id, String, objective id
     Return:
-        Objetive block
-        https://open.feishu.cn/document/uAjLw4CM/ukTMukTMukTM/reference/okr-v1/user-okr/list
-        Obj list element
+        okr_objects.Objective, None if the user does not have it
     """
-    obj_list = get_obj_list_from_okr_str(rds.hget(name=open_id, key='okr'))
-
-    for obj in obj_list:
-        if obj['id'] == obj_id:
-            return obj
-    return {}
+    return _get_okr(open_id).objective(obj_id)
 
 
 def mentioned_people_list(obj):
     """
     Args:
-        Obj dict,
-        Reference https://open.feishu.cn/document/uAjLw4CM/ukTMukTMukTM/reference/okr-v1/user-okr/list
+        okr_objects.Objective
     Return:
-        Open id List directly mentioned in the obj
+        Open id List directly mentioned in the obj or its KRs
     """
-
-    mentioned_list = []
     if not obj:
-        return mentioned_list
-    try:
-        for mentioned in obj['mentioned_user_list']:
-            mentioned_list.append(mentioned['open_id'])
-
-        for kr in obj['kr_list']:
-            for mentioned in kr['mentioned_user_list']:
-                mentioned_list.append(mentioned['open_id'])
-    except Exception as e:  # some one do not have kr_list
-        my_app.logger.error(e)
-
-    return list(set(mentioned_list))
+        return []
+    return list(obj.mentioned)
 
 
 def count_people_on_obj(open_id, obj):
     """
     Args:
         open_id, String, who has the obj
-        OKR obj
-        https://open.feishu.cn/document/uAjLw4CM/ukTMukTMukTM/reference/okr-v1/user-okr/list
-        Notice: Aligned and aligning objs are dict like
-        {
-            "id": "7115374114517467138",
-            "okr_id": "7109919013166530588",
-            "owner": {
-                "open_id": "ou_db8862f87c8586931bde2d7ef7b0725b",
-                "user_id": "ou_db8862f87c8586931bde2d7ef7b0725b"
-            }
-        }
+        okr_objects.Objective, its aligned objs are (open_id of the owner, obj id)
     Return:
         People list who is aligned to the obj.
     """
     people_name_list = [open_id]  # add myself first
     people_leveraged_name_list = mentioned_people_list(obj)
 
-    for aligned_obj in obj['aligned_objective_list']:  # child objs
-        objective = get_obj_by_obj_id(aligned_obj['owner']['open_id'], aligned_obj['id'])
+    for owner_id, obj_id in obj.aligned:  # child objs
+        objective = get_obj_by_obj_id(owner_id, obj_id)
         if objective:  # since people dynamically change, the obj could be none
-            if _is_subordinate(open_id, aligned_obj['owner']['open_id']):  # only count in subordinates
-                p_list, p_l_list = count_people_on_obj(aligned_obj['owner']['open_id'], objective)
+            if _is_subordinate(open_id, owner_id):  # only count in subordinates
+                p_list, p_l_list = count_people_on_obj(owner_id, objective)
                 people_name_list.extend(p_list)
                 people_leveraged_name_list.extend(p_l_list)
             else:  # count into leveraged people if not my subordinates
@@ -1015,7 +959,7 @@ def get_invisible_people(open_id, people_on_total):
     Notice:
         This is quicker version
     """
-    my_subordinates_str = rds.hget(name=open_id, key='all_sub')
+    my_subordinates_str = rds.hget(name=_user_key(open_id), key='all_sub')
 
     if my_subordinates_str:
         my_total_people = my_subordinates_str.split(';')
@@ -1038,25 +982,32 @@ def get_objs_stat_info(open_id):
         Also the list of invisible people [name,url_id,avatar]
 
     """
-    okr_str = rds.hget(name=open_id, key='okr')
-    obj_list = get_obj_list_from_okr_str(okr_str)
-    obj_stat_list = []
-    i = 0
+    obj_list = _get_okr(open_id).objectives
+    obj_people = []
     people_on_total = []
     for obj in obj_list:
         people_on, people_leveraged = count_people_on_obj(open_id, obj)
         people_on_total.extend(people_on)  # record all people in all objs
         # remove my own people from the people_leverage_name_list
-        people_external_leverage = []
-        for leveraged in people_leveraged:
-            if not _is_subordinate(open_id, leveraged):
-                people_external_leverage.append(leveraged)
+        nil, people_external_leverage = _split_subordinates(open_id, people_leveraged)
+        obj_people.append((people_on, people_external_leverage))
+
+    people_list_invisible = get_invisible_people(open_id, people_on_total)
 
+    # the names of all the people are read in one round trip
+    cards = users_store.get_cards(people_on_total
+                                  + [o_id for nil, people in obj_people for o_id in people]
+                                  + list(people_list_invisible))
+
+    obj_stat_list = []
+    i = 0
+    for people_on, people_external_leverage in obj_people:
         people_on.sort()
         people_external_leverage.sort()
-        people_on = [rds.hget(name=o_id, key='name') for o_id in people_on]
-        people_external_leverage = [rds.hget(name=o_id, key='name') for o_id in people_external_leverage]
-        people_on = list(filter(None, people_on))  # Along with the employee change, there are None people possibly
+        # Along with the employee change, there are gone people possibly
+        people_on = [cards[o_id]['name'] for o_id in people_on if o_id in cards]
+        people_external_leverage = [cards[o_id]['name'] for o_id in people_external_leverage if o_id in cards]
+        people_on = list(filter(None, people_on))
         people_external_leverage = list(filter(None, people_external_leverage))
         i += 1
 
@@ -1066,11 +1017,10 @@ def get_objs_stat_info(open_id):
                               str(len(people_external_leverage)),
                               ','.join(people_external_leverage)])
 
-    people_list_invisible = get_invisible_people(open_id, people_on_total)
-    _people_list_invisible = [[rds.hget(name=o_id, key='name'),
-                               URL_BASE + rds.hget(name=o_id, key='url_id'),  # we can optimize here later
-                               rds.hget(name=o_id, key='avatar')]
-                              for o_id in people_list_invisible]
+    _people_list_invisible = [[cards[o_id]['name'],
+                               URL_BASE + cards[o_id]['url_id'],
+                               cards[o_id]['avatar']]
+                              for o_id in people_list_invisible if o_id in cards]
     if len(people_on_total) > 0:
         return obj_stat_list, \
                _people_list_invisible, \
@@ -1134,7 +1084,7 @@ def get_subscribe():
     else:  # list all the subscription for the user
         key_word_rich_list = get_subscribe_key_word(session['user'])
         return render_template('subscribe.html',
-                               current_user=rds.hget(name=session['user'], key='name'),
+                               current_user=_get_name(session['user']),
                                key_word_rich_list=key_word_rich_list)
 
 
@@ -1358,19 +1308,20 @@ def get_graph():
     objs_list = []
     if not who:  # return the current user's
         objs, invisible_people, align_ratio, leverage_ratio = get_objs_stat_info(session['user'])
-        objs_list.append([rds.hget(name=session['user'], key='name'),
+        objs_list.append([_get_name(session['user']),
                           objs,
                           invisible_people,
                           align_ratio,
                           leverage_ratio])
 
     elif who == 'sub':
-        sub_str = rds.hget(name=session['user'], key='direct_sub')
+        sub_str = rds.hget(name=_user_key(session['user']), key='direct_sub')
         if sub_str:
             direct_report_list = sub_str.split(';')
+            cards = users_store.get_cards(direct_report_list)
             for sub_user in direct_report_list:
                 objs, invisible_people, align_ratio, leverage_ratio = get_objs_stat_info(sub_user)
-                objs_list.append([rds.hget(name=sub_user, key='name'),
+                objs_list.append([cards.get(sub_user, {}).get('name'),
                                   objs,
                                   invisible_people,
                                   align_ratio,
@@ -1409,7 +1360,8 @@ def get_similarities():
 
     """
     display = get_search_display_similarites(session['user'])
-    return render_template('similarity.html', current_user=rds.hget(name=session['user'], key='name'), display=display)
+    return render_template('similarity.html', current_user=_get_name(session['user']),
+                           display=display)
 
 
 class Key2user(db.Model):
@@ -1419,6 +1371,12 @@ class Key2user(db.Model):
     howchanged = db.Column(db.String(64))
 
 
+class Key2user_posting(db.Model):
+    seg = db.Column(db.String(128), primary_key=True, nullable=False)
+    open_id = db.Column(db.String(64), primary_key=True, nullable=False)
+    num = db.Column(db.Integer)
+
+
 class Users(db.Model):
     open_id = db.Column(db.String(64), primary_key=True, nullable=False)
     okr = db.Column(db.Text)
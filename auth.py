@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
-import requests
 import logging
+import rate_limiter
 
 # const
 # 开放接口 URI
@@ -24,7 +24,7 @@ class Auth(object):
             "Authorization": "Bearer " + self.tenant_access_token,
             "Content-Type": "application/json",
         }
-        resp = requests.post(url=url, headers=headers)
+        resp = rate_limiter.request("POST", url, headers=headers)
         Auth._check_error_response(resp)
         return resp.json().get("data").get("ticket", "")
 
@@ -34,7 +34,7 @@ class Auth(object):
         # https://open.feishu.cn/document/ukTMukTMukTM/ukDNz4SO0MjL5QzM/auth-v3/auth/tenant_access_token_internal
         url = "{}{}".format(self.feishu_host, TENANT_ACCESS_TOKEN_URI)
         req_body = {"app_id": self.app_id, "app_secret": self.app_secret}
-        response = requests.post(url, req_body)
+        response = rate_limiter.request("POST", url, data=req_body)
         Auth._check_error_response(response)
         self.tenant_access_token = response.json().get("tenant_access_token")
 
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import time
+
+from my_utils import my_log
+
+# The file keeps the progress of a rebuild, so a rebuild broken halfway is resumed instead of started over.
+#
+# A rebuild is a list of stages, each is marked when it is finished. The users stage is also checkpointed
+# per batch: each batch of users is committed into the shadow users table before it is counted here, so the
+# shadow table itself tells which users are done. The key2user changes are computed once and kept beside
+# the checkpoint before they are written, so the writes can be replayed exactly after a crash.
+
+
+class Checkpoint(object):
+    """
+    Args:
+        path: String, the checkpoint file, empty keeps it only in memory
+        mode: String, the rebuild mode, 'hard' or 'soft'
+    """
+
+    def __init__(self, path='', mode='soft'):
+        self.path = path
+        self.data = {'mode': mode, 'started': time.time(), 'stages': {}, 'batches': 0, 'users': 0}
+
+    @classmethod
+    def resume(cls, path, mode, max_age):
+        """
+        Return:
+            the Checkpoint left in path by a broken rebuild of the same mode and younger than max_age
+            seconds, otherwise a new one
+        """
+        checkpoint = cls(path, mode)
+        if not path or not os.path.exists(path):
+            return checkpoint
+
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+        except ValueError as e:
+            my_log('ignore the broken checkpoint %s: %s' % (path, e), level='WARNING')
+            checkpoint.clear()
+            return cls(path, mode)
+
+        if data.get('mode') != mode or time.time() - data.get('started', 0) > max_age:
+            my_log('start over, the checkpoint %s is of another mode or too old' % path, level='DEBUG')
+            checkpoint.clear()
+            return cls(path, mode)
+
+        checkpoint.data = data
+        my_log('resume the rebuild, finished stages %s, %s batches of users'
+               % (list(data['stages']), data['batches']), level='DEBUG')
+        return checkpoint
+
+    @property
+    def mode(self):
+        return self.data['mode']
+
+    def started(self, stage):
+        return stage in self.data['stages']
+
+    def done(self, stage):
+        return bool(self.data['stages'].get(stage))
+
+    def start(self, stage):
+        if not self.started(stage):
+            self.data['stages'][stage] = 0
+            self.save()
+
+    def finish(self, stage):
+        self.data['stages'][stage] = time.time()
+        self.save()
+
+    def batch_done(self, users):
+        """
+        Called after a batch of users is committed into the shadow users table
+        """
+        self.data['batches'] += 1
+        self.data['users'] += users
+        self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.data, f)
+        os.replace(tmp, self.path)
+
+    def _plan_path(self, name):
+        return '%s.%s' % (self.path, name)
+
+    def save_plan(self, name, plan):
+        """
+        Keep the computed writes of a stage beside the checkpoint, see load_plan()
+        """
+        if not self.path:
+            return
+        tmp = self._plan_path(name) + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(plan, f, ensure_ascii=False)
+        os.replace(tmp, self._plan_path(name))
+
+    def load_plan(self, name):
+        """
+        Return:
+            the plan saved by save_plan(), None if there is not
+        """
+        if not self.path or not os.path.exists(self._plan_path(name)):
+            return None
+        try:
+            with open(self._plan_path(name), encoding='utf-8') as f:
+                return json.load(f)
+        except ValueError:
+            return None
+
+    def clear(self):
+        """
+        The rebuild is finished, remove the checkpoint and the plans
+        """
+        if not self.path:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        prefix = os.path.basename(self.path)
+        for name in os.listdir(directory):
+            if name == prefix or name.startswith(prefix + '.'):
+                os.remove(os.path.join(directory, name))
@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
-import requests
 import json
 import os
 import time
-import my_utils
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import rate_limiter
+import my_pipeline
+import profiler
+import org_tree
 from my_utils import my_error, my_log
 from dotenv import load_dotenv, find_dotenv
 
@@ -13,6 +17,11 @@ load_dotenv(find_dotenv())
 APP_ID = os.getenv("APP_ID")
 APP_SECRET = os.getenv("APP_SECRET")
 FEISHU_HOST = os.getenv("FEISHU_HOST")
+# how many Feishu requests can be in flight when fetching users department by department
+FEISHU_WORKERS = int(os.getenv("FEISHU_WORKERS") if os.getenv("FEISHU_WORKERS") else '8')
+# the department tree snapshot file, and how many seconds it is trusted without fetching again
+ORG_TREE_FILE = os.getenv("ORG_TREE_FILE") if os.getenv("ORG_TREE_FILE") else 'org_tree.json'
+ORG_TREE_TTL = int(os.getenv("ORG_TREE_TTL") if os.getenv("ORG_TREE_TTL") else '3600')
 
 CURRENT_PERIOD = "2022 年 10 月 - 12 月"
 
@@ -20,6 +29,15 @@ token_expire = time.time()
 
 tenant_access_token = ''
 
+# the token may be refreshed from several worker threads at the same time
+token_lock = threading.Lock()
+
+# the id of CURRENT_PERIOD in the Feishu OKR system, looked up once
+current_period_id = None
+
+# the org_tree.OrgTree of the last rebuild
+org_tree_snapshot = None
+
 
 # get the tenant_access_token
 def get_access_token():
@@ -31,6 +49,17 @@ def get_access_token():
     if now < token_expire - 10 and tenant_access_token:
         return tenant_access_token, ''
 
+    with token_lock:
+        if time.time() < token_expire - 10 and tenant_access_token:  # refreshed by another thread
+            return tenant_access_token, ''
+        return _refresh_access_token()
+
+
+@profiler.timed('token_fetch')
+def _refresh_access_token():
+    global token_expire
+    global tenant_access_token
+
     url = "https://open.feishu.cn/open-apis/auth/v3/app_access_token/internal"
 
     payload = json.dumps({
@@ -42,7 +71,7 @@ def get_access_token():
         'Content-Type': 'application/json'
     }
 
-    response = requests.request("POST", url, headers=headers, data=payload)
+    response = rate_limiter.request("POST", url, headers=headers, data=payload)
 
     data = json.loads(response.text)
     """
@@ -63,6 +92,20 @@ def get_access_token():
 
 
 def get_all_child_departments(dep_id):
+    """
+    Return:
+        List of the open_department_id of all the departments under dep_id at any level, from the org tree snapshot
+    """
+    return get_org_tree().descendants(dep_id)
+
+
+@profiler.timed('department_walk')
+def get_all_child_department_dicts(dep_id):
+    """
+    Return:
+        List, all the departments under dep_id at any level, each item is a depart dict,
+        see get_all_direct_child_departs()
+    """
     url = "https://open.feishu.cn/open-apis/contact/v3/departments/" + \
           dep_id + \
           "/children?department_id_type=open_department_id" \
@@ -76,7 +119,7 @@ def get_all_child_departments(dep_id):
         'Authorization': 'Bearer ' + tenant_access_token
     }
 
-    response = requests.request("GET", url, headers=headers, data=payload)
+    response = rate_limiter.request("GET", url, headers=headers, data=payload)
 
     data = json.loads(response.text)
 
@@ -84,21 +127,19 @@ def get_all_child_departments(dep_id):
 
     departments_list = []
     if 'items' in data['data'].keys():
-        for item in data['data']['items']:
-            departments_list.append(item['open_department_id'])
+        departments_list.extend(data['data']['items'])
 
     while data['data']['has_more']:
         page_token = data['data']['page_token']
 
         new_url = url + '&page_token=' + page_token
 
-        response = requests.request("GET", new_url, headers=headers, data=payload)
+        response = rate_limiter.request("GET", new_url, headers=headers, data=payload)
 
         data = json.loads(response.text)
 
         if 'items' in data['data'].keys():
-            for item in data['data']['items']:
-                departments_list.append(item['open_department_id'])
+            departments_list.extend(data['data']['items'])
 
     return departments_list
 
@@ -135,66 +176,23 @@ def get_all_direct_child_departs(open_dep_id):
     Reference:
 
     https://open.feishu.cn/document/uAjLw4CM/ukTMukTMukTM/reference/contact-v3/department/children
-    """
-
-    dep_list = []
-
-    tenant_access_token, app_access_token = get_access_token()
-
-    url = "https://open.feishu.cn/open-apis/contact/v3/departments/" + \
-          open_dep_id + \
-          "/children?department_id_type=open_department_id&page_size=10&user_id_type=open_id"
-    payload = ''
-
-    headers = {
-        'Authorization': 'Bearer ' + tenant_access_token
-    }
 
-    response = requests.request("GET", url, headers=headers, data=payload)
-
-    data = json.loads(response.text)
-
-    # It is possible that there is no items key
-    try:
-        if 'items' in data['data'].keys():
-            for dep in data['data']['items']:
-                if dep not in dep_list:
-                    dep_list.append(dep)
-    except Exception as e:
-        my_error(e)
-
-    while 'has_more' in data['data'].keys() and data['data']['has_more']:
-        page_token = data['data']['page_token']
-
-        new_url = url + '&page_token=' + page_token
-
-        response = requests.request("GET", new_url, headers=headers, data=payload)
-
-        data = json.loads(response.text)
-
-        # It is possible that there is no items key
-        try:
-            if 'items' in data['data'].keys():
-                for dep in data['data']['items']:
-                    if dep not in dep_list:
-                        dep_list.append(dep)
-        except Exception as e:
-            my_error(e)
-
-    return dep_list
+    The departments are answered from the org tree snapshot, see get_org_tree()
+    """
+    return get_org_tree().direct_children(open_dep_id)
 
 
 def get_all_second_level_departs():
-    first_level_departs = get_all_direct_child_departs("0")
+    tree = get_org_tree()
     second_level_departs = []
-    for fld in first_level_departs:
+    for fld in tree.direct_children(org_tree.ROOT):
         if 'leader_user_id' in fld.keys():
-            second_level_departs[len(second_level_departs):len(second_level_departs)] = \
-                get_all_direct_child_departs(fld['open_department_id'])
+            second_level_departs.extend(tree.direct_children(fld['open_department_id']))
 
     return second_level_departs
 
 
+@profiler.timed('user_fetch')
 def _get_direct_user_dicts_in_dep(dep_id):
 
     user_dict_list = []
@@ -210,7 +208,7 @@ def _get_direct_user_dicts_in_dep(dep_id):
 
     payload = ''
 
-    response = requests.request("GET", url, headers=headers, data=payload)
+    response = rate_limiter.request("GET", url, headers=headers, data=payload)
 
     data = json.loads(response.text)
 
@@ -227,7 +225,7 @@ def _get_direct_user_dicts_in_dep(dep_id):
 
             new_url = url + '&page_token=' + page_token
 
-            response = requests.request("GET", new_url, headers=headers, data=payload)
+            response = rate_limiter.request("GET", new_url, headers=headers, data=payload)
 
             data = json.loads(response.text)
 
@@ -238,31 +236,90 @@ def _get_direct_user_dicts_in_dep(dep_id):
 
     except Exception as e:
         my_error(e)
-        return []
+        return None  # failed, different from a department without users
 
     return user_dict_list
 
 
 def get_direct_user_dicts_in_dep(dep_id):
+    # rate limiting is retried by the scheduler, here only retry the failed ones
     retry = 3
     result = _get_direct_user_dicts_in_dep(dep_id)
-    while result == [] and retry > 0:
+    while result is None and retry > 0:
         retry -= 1
         result = _get_direct_user_dicts_in_dep(dep_id)
-    return result
+    return result if result is not None else []
 
 
 def get_direct_user_ids_in_dep(open_id):
-    user_openid_list = []
-    user_dict_list = get_direct_user_dicts_in_dep(open_id)
-    for user in user_dict_list:
-        user_openid_list.append(user['open_id'])
-    return user_openid_list
+    return get_org_tree().direct_members(open_id)
 
 
-def get_all_user_dict_from_feishu():
+def fetch_org_tree(workers=FEISHU_WORKERS):
     """
-    Return: A list of user
+    Fetch the whole department tree in one fetch_child=true walk and the direct members of each department.
+    Return:
+        org_tree.OrgTree
+    """
+    t1 = time.time()
+
+    tree = org_tree.OrgTree()
+    for dep in get_all_child_department_dicts(org_tree.ROOT):
+        tree.add_department(dep)
+
+    t2 = time.time()
+
+    get_access_token()  # get the token ready before the workers share it
+
+    dep_list = list(tree.departments)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for dep_id, user_dict_list in zip(dep_list, executor.map(get_direct_user_dicts_in_dep, dep_list)):
+            tree.set_members(dep_id, [user['open_id'] for user in user_dict_list])
+
+    my_log('org tree has %s departments, walk used %.3f seconds, members used %.3f seconds'
+           % (len(tree.departments), t2 - t1, time.time() - t2), level='DEBUG')
+
+    return tree
+
+
+def set_org_tree(tree):
+    """
+    Make tree the current snapshot and save it on disk
+    """
+    global org_tree_snapshot
+    org_tree_snapshot = tree
+    try:
+        tree.save(ORG_TREE_FILE)
+    except OSError as e:
+        my_error(e)
+
+
+def get_org_tree(refresh=False):
+    """
+    Return:
+        org_tree.OrgTree, the snapshot in memory, or on disk, if it is younger than ORG_TREE_TTL.
+        Otherwise (or refresh is True) it is fetched from Feishu.
+    """
+    global org_tree_snapshot
+
+    if not refresh:
+        if org_tree_snapshot is not None and org_tree_snapshot.age() < ORG_TREE_TTL:
+            return org_tree_snapshot
+        tree = org_tree.OrgTree.load(ORG_TREE_FILE)
+        if tree is not None and tree.age() < ORG_TREE_TTL:
+            org_tree_snapshot = tree
+            return tree
+
+    tree = fetch_org_tree()
+    set_org_tree(tree)
+    return tree
+
+
+def iter_all_user_dicts_from_feishu(workers=FEISHU_WORKERS):
+    """
+    Return:
+        generator of the user dicts, each user comes out once, as soon as his/her department is fetched.
+        Only the open ids seen so far are kept in memory.
     A User is a dict.
     "avatar": a dict
     "city":
@@ -289,52 +346,97 @@ def get_all_user_dict_from_feishu():
     "user_id":
     "work_station":
 
-    Reference:
-    https://open.feishu.cn/document/uAjLw4CM/ukTMukTMukTM/reference/contact-v3/user/find_by_department
+    The department tree and the members are recorded on the way, once all the users are streamed,
+    they become the org tree snapshot, so the departments are not fetched again in the same rebuild.
     """
+    t1 = time.time()
 
-    dep_list = get_all_child_departments("0")
+    tree = org_tree.OrgTree()
+    for dep in get_all_child_department_dicts(org_tree.ROOT):
+        tree.add_department(dep)
+    dep_list = list(tree.departments)
 
-    my_utils.my_log('we have %s departments' % len(dep_list), level='DEBUG')
+    t2 = time.time()
+    my_log('we have %s departments, department walk used %.3f seconds'
+           % (len(dep_list), t2 - t1), level='DEBUG')
 
-    user_ids_list = []
+    get_access_token()  # get the token ready before the workers share it
 
-    tenant_access_token, app_access_token = get_access_token()
+    seen = set()
+    for dep_id, user_dict_list in my_pipeline.bounded_imap(get_direct_user_dicts_in_dep, dep_list, workers):
+        tree.set_members(dep_id, [user['open_id'] for user in user_dict_list])
+        for user in user_dict_list:
+            if user['open_id'] not in seen:
+                seen.add(user['open_id'])
+                yield user
 
-    headers = {
-        'Authorization': 'Bearer ' + tenant_access_token
-    }
+    my_log('streamed %s users with %s workers, used %.3f seconds'
+           % (len(seen), workers, time.time() - t2), level='DEBUG')
 
-    for dep_id in dep_list:
-        user_ids_list[len(user_ids_list):len(user_ids_list)] = get_direct_user_dicts_in_dep(dep_id)
-
-    return my_utils.delete_duplicate_list(user_ids_list)
+    set_org_tree(tree)
 
 
 def get_all_users_in_dep(dep_id):
     """
     Return all the users in one dep in List.
     The element of the List is the open id
+    They are collected from the org tree snapshot in O(subtree), see get_org_tree()
     """
 
-    user_list = get_direct_user_ids_in_dep(dep_id)
+    user_list = list(get_org_tree().users_in(dep_id))
+
+    my_log('dep %s has %s users' % (dep_id, len(user_list)), level='DEBUG')
+
+    return user_list
 
-    my_log('dep %s has %s direct user' % (dep_id, len(user_list)), level='DEBUG')
 
-    dep_list = get_all_child_departments(dep_id)
+def get_current_period_id(refresh=False):
+    """
+    Args:
+        refresh: Boolean, look it up again instead of using the one kept
+    return: the Feishu id of the OKR period named CURRENT_PERIOD, '' if it is not found.
+        It is kept until the next refresh, a failed lookup too, so the users of one run do not look it up again.
+    Ref: https://open.feishu.cn/document/uAjLw4CM/ukTMukTMukTM/reference/okr-v1/period/list
+    """
+    global current_period_id
 
-    my_log('dep %s has %s child dep' % (dep_id, len(dep_list)), level='DEBUG')
+    if current_period_id is not None and not refresh:
+        return current_period_id
 
-    for dep_id in dep_list:
-        user_list[len(user_list):len(user_list)] = get_direct_user_ids_in_dep(dep_id)
+    tenant_access_token, app_access_token = get_access_token()
 
-    user_list = list(set(user_list))
+    url = "https://open.feishu.cn/open-apis/okr/v1/periods?page_size=100"
 
-    my_log('dep %s has %s users' % (dep_id, len(user_list)), level='DEBUG')
+    payload = ''
 
-    return user_list
+    headers = {
+        'Authorization': 'Bearer ' + tenant_access_token
+    }
+
+    period_id = ''
+    try:
+        new_url = url
+        while True:
+            response = rate_limiter.request("GET", new_url, headers=headers, data=payload)
+            data = json.loads(response.text)
+            if data['code'] != 0:
+                my_error('failed to list the OKR periods: %s' % data['msg'])
+                break
+            for period in data['data'].get('items', []):
+                if period['zh_name'] == CURRENT_PERIOD:
+                    period_id = period['id']
+            if period_id or not data['data'].get('has_more'):
+                break
+            new_url = url + '&page_token=' + data['data']['page_token']
+    except Exception as e:
+        my_error(e)
 
+    my_log('the id of period %s is %s' % (CURRENT_PERIOD, period_id), level='DEBUG')
+    current_period_id = period_id
+    return current_period_id
 
+
+@profiler.timed('okr_fetch')
 def get_latest_okr_by_open_id(open_id):
     """
     return: the latest period OKR dict
@@ -347,13 +449,17 @@ def get_latest_okr_by_open_id(open_id):
     url = "https://open.feishu.cn/open-apis/okr/v1/users/" \
           + open_id + "/okrs?lang=zh_cn&limit=10&offset=0&user_id_type=open_id"
 
+    period_id = get_current_period_id()
+    if period_id:  # only download the current period, instead of the latest 10 ones
+        url += '&period_ids=' + period_id
+
     payload = ''
 
     headers = {
         'Authorization': 'Bearer ' + tenant_access_token
     }
 
-    response = requests.request("GET", url, headers=headers, data=payload)
+    response = rate_limiter.request("GET", url, headers=headers, data=payload)
 
     data = json.loads(response.text)
 
@@ -363,6 +469,25 @@ def get_latest_okr_by_open_id(open_id):
                 return data['data']['okr_list'][i]
 
 
+def iter_latest_okrs(open_ids, workers=FEISHU_WORKERS):
+    """
+    Args:
+        open_ids: iterable of the user open ids, consumed lazily
+        workers: Int, how many users are fetched at the same time
+    Return:
+        generator of (open_id, okr_dict), see get_latest_okr_by_open_id().
+        The pairs come out as soon as they are fetched, not in the order of open_ids.
+    Notice:
+        Feishu has no endpoint to list the OKRs of many users in one call,
+        so the users are fanned out to a bounded number of workers.
+    """
+    get_access_token()  # get the token and the period ready before the workers share them
+    get_current_period_id(refresh=True)  # each rebuild or refresh looks it up again, e.g. after a failed lookup
+
+    for open_id, okr_dict in my_pipeline.bounded_imap(get_latest_okr_by_open_id, open_ids, workers):
+        yield open_id, okr_dict
+
+
 def get_user_by_temp_auth(auth):
     """
     Args:
@@ -407,7 +532,7 @@ def get_user_by_temp_auth(auth):
         'Authorization': 'Bearer ' + tenant_access_token
     }
 
-    response = requests.request("POST", url, headers=headers, data=payload)
+    response = rate_limiter.request("POST", url, headers=headers, data=payload)
 
     data = json.loads(response.text)
     return data['data']
@@ -436,7 +561,7 @@ def send_notify(app, to_open_id, msg_content, msg_type):
         'Authorization': 'Bearer ' + tenant_access_token,  # your access token
         'Content-Type': 'application/json'
     }
-    response = requests.request("POST", url, params=params, headers=headers, data=payload)
+    response = rate_limiter.request("POST", url, params=params, headers=headers, data=payload)
     app.logger.debug(response.headers['X-Tt-Logid'])  # for debug or oncall
     app.logger.debug(response.content)  # Print Response
     result = json.loads(response.content)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import requests
+import profiler
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv, find_dotenv
+
+# The file keeps one shared HTTP session for all the calls to Feishu and other servers.
+# The session pools the connections and keeps them alive, so a rebuild reuses a few sockets
+# instead of opening a new TCP and TLS connection for every request.
+
+# get environmental parameter from .env files
+load_dotenv(find_dotenv())
+
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE") if os.getenv("HTTP_POOL_SIZE") else '16')
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT") if os.getenv("HTTP_TIMEOUT") else '30')  # in seconds
+
+session = None
+
+session_lock = threading.Lock()
+
+
+def new_session(pool_size=HTTP_POOL_SIZE):
+    """
+    Args:
+        pool_size: Int, how many connections are kept alive per host
+    Return:
+        a requests Session with pooled adapters mounted for http and https
+    """
+    s = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    s.mount('https://', adapter)
+    s.mount('http://', adapter)
+    return s
+
+
+def get_session():
+    global session
+
+    if session is None:
+        with session_lock:
+            if session is None:
+                session = new_session()
+    return session
+
+
+def set_session(new):
+    """
+    Replace the shared session, e.g. with a differently sized pool.
+    The old session is closed.
+    """
+    global session
+
+    with session_lock:
+        old = session
+        session = new
+    if old is not None and old is not new:
+        old.close()
+
+
+def request(method, url, timeout=HTTP_TIMEOUT, **kwargs):
+    """
+    Same as requests.request, but goes through the shared session and always has a timeout
+    """
+    response = get_session().request(method, url, timeout=timeout, **kwargs)
+    if profiler.profiler.enabled:
+        profiler.add(transferred=len(response.content))
+    return response
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+
+# Helpers to run the network bound steps of a rebuild concurrently while keeping a bound
+# on how much work is taken ahead of the consumer.
+
+
+def bounded_imap(func, iterable, workers, max_pending=None):
+    """
+    Args:
+        func: function, called with each item in a worker thread
+        iterable: the items, consumed lazily
+        workers: Int, how many threads run func at the same time
+        max_pending: Int, at most how many items are taken from iterable but not yet yielded,
+                     2 * workers by default. It is the backpressure on the producer.
+    Return:
+        generator of (item, func(item)), in the order they are finished instead of the input order.
+        An exception raised in func is raised again here.
+    """
+    max_pending = max_pending if max_pending else 2 * workers
+
+    it = iter(iterable)
+    exhausted = False
+    pending = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            while not exhausted and len(pending) < max_pending:
+                try:
+                    item = next(it)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending[executor.submit(func, item)] = item
+
+            if not pending:
+                return
+
+            done, nil = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                yield item, future.result()
+
+
+def batched(iterable, size):
+    """
+    Return:
+        generator of lists, each has <size> items except the last one
+    """
+    it = iter(iterable)
+    while True:
+        batch = list(islice(it, size))
+        if not batch:
+            return
+        yield batch
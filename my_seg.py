@@ -2,38 +2,95 @@
 import jieba
 from dotenv import load_dotenv, find_dotenv
 import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 # get env parameters
 import my_utils
+import hashlib
 
 load_dotenv(find_dotenv())
 
 STOP_WORDS = os.getenv("STOP_WORDS")
+# the serialized jieba dictionary, built at the first start and loaded directly afterwards, relative to the working directory
+JIEBA_CACHE = os.getenv("JIEBA_CACHE") if os.getenv("JIEBA_CACHE") else 'jieba.cache'
+# the organisation vocabulary built by okr_vocab.py, optional
+USER_DICT = os.getenv("USER_DICT") if os.getenv("USER_DICT") else ''
+# how many processes segment the OKRs in seg_many()
+SEG_WORKERS = int(os.getenv("SEG_WORKERS") if os.getenv("SEG_WORKERS") else str(os.cpu_count() or 1))
 
-stop_list = []
+stop_set = frozenset()
 
+warmed = False
 
-def load_stop_words():
-    global stop_list
+seg_pool = None  # the process pool of seg_many(), created at the first use and kept
 
-    if stop_list:
-        return stop_list
+# The pool is created while the fetch threads of the rebuild are running. A forked worker could inherit the
+# locks those threads hold (logging, urllib3), so the workers are started by a fork server instead.
+SEG_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
 
-    with open(STOP_WORDS, 'r') as f:
-        line = f.readline()
-        while line:
-            line = line.replace('\n', '')
-            stop_list.append(line)
-            line = f.readline()
-        f.close()
 
-    return stop_list
+def load_stop_words():
+    """
+    Return:
+        frozenset of the stop words, loaded once
+    """
+    global stop_set
+
+    if stop_set:
+        return stop_set
+
+    with open(STOP_WORDS, 'r', encoding='utf-8') as f:
+        stop_set = frozenset(line.replace('\n', '') for line in f)
+
+    return stop_set
+
+
+def warm_up(user_dict=True):
+    """
+    Load the jieba dictionary, the user dictionary and the stop words now, instead of at the first my_seg() call.
+    The dictionary is loaded from JIEBA_CACHE, which jieba builds there if it is missing.
+    Args:
+        user_dict: Boolean, False to leave USER_DICT out, the segmentation is by the default dictionary only
+    """
+    global warmed
+
+    if warmed:
+        return
+
+    t1 = time.time()
+    jieba.dt.cache_file = os.path.abspath(JIEBA_CACHE)  # jieba puts a relative path under the temp dir
+    jieba.initialize()
+    if user_dict and USER_DICT and os.path.exists(USER_DICT):
+        jieba.load_userdict(USER_DICT)
+    load_stop_words()
+    warmed = True
+    my_utils.my_log('segmentation is warmed up, used %.3f seconds' % (time.time() - t1), level='DEBUG')
+
+
+def dict_fingerprint():
+    """
+    Return:
+        String, changes when the user dictionary or the stop words change, so the segmentation results
+        cached before are stale
+    """
+    md5 = hashlib.md5()
+    for path in (USER_DICT, STOP_WORDS):
+        if path and os.path.exists(path):
+            with open(path, 'rb') as f:
+                md5.update(f.read())
+        md5.update(b'\0')  # keeps a missing file apart from an empty one in the other place
+    return md5.hexdigest()
 
 
 def my_seg(to_seg_str):
 
+    if not warmed:
+        warm_up()
+
     seg_dict = {}
-    stop_words_list = load_stop_words()
+    stop_words = load_stop_words()
 
     seg_list = jieba.lcut_for_search(to_seg_str)
     # debug
@@ -43,7 +100,7 @@ def my_seg(to_seg_str):
         seg = seg.lower()
         if seg \
                 and not my_utils.single_asc(seg) \
-                and seg not in stop_words_list \
+                and seg not in stop_words \
                 and seg.find(';') < 0:
 
             if seg in seg_dict.keys():
@@ -53,3 +110,34 @@ def my_seg(to_seg_str):
 
 
     return seg_dict
+
+
+def _init_seg_worker():
+    # load the jieba dictionary and stop words once when the worker process starts
+    warm_up()
+
+
+def _get_seg_pool(workers):
+    global seg_pool
+
+    if seg_pool is None:
+        seg_pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_seg_worker,
+                                       mp_context=multiprocessing.get_context(SEG_START_METHOD))
+    return seg_pool
+
+
+def seg_many(texts, workers=SEG_WORKERS, chunksize=8):
+    """
+    Args:
+        texts: iterable of String
+        workers: Int, how many processes segment the texts, 1 means in the current process
+        chunksize: Int, how many texts are sent to a worker at a time
+    Return:
+        List of seg dicts, the same as [my_seg(text) for text in texts], in the same order
+    """
+    texts = list(texts)
+
+    if workers <= 1 or len(texts) <= 1:
+        return [my_seg(text) for text in texts]
+
+    return list(_get_seg_pool(workers).map(my_seg, texts, chunksize=chunksize))
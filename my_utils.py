@@ -30,12 +30,6 @@ def init_log(logfile, level='WARNING'):
     logger.addHandler(Rthandler)
 
 
-def delete_duplicate_list(li):
-    temp_list = list(set([str(i) for i in li]))
-    li = [eval(i) for i in temp_list]
-    return li
-
-
 def my_error(e):
     """
     Args:
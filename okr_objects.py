@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import threading
+
+from my_utils import find_any_of
+
+# The file keeps the OKRs of the users parsed, for the OkrEx Server.
+#
+# The raw OKR in the users cache is the JSON of the feishu OKR list API, see get_latest_okr_by_open_id().
+# The views only need the objectives, their KRs, the alignments and the mentioned users, so each OKR is
+# parsed once into the compact objects below and kept per process, keyed by the open_id and the hashcode
+# of the raw OKR. A request only reads the hashcode; the OKR is fetched and parsed when the hashcode
+# changes, e.g. after a rebuild. The cache is emptied on /rebuild, holding one OKR per user at most.
+#
+# Reference:
+# https://open.feishu.cn/document/uAjLw4CM/ukTMukTMukTM/reference/okr-v1/user-okr/list
+
+
+def okr_hashcode(okr_str):
+    """
+    Return:
+        String, the hashcode of the raw OKR, '' if there is not
+    """
+    if not okr_str:
+        return ''
+    return hashlib.md5(okr_str.encode('utf-8')).hexdigest()
+
+
+class Kr(object):
+    __slots__ = ('content', 'mentioned')
+
+    def __init__(self, content, mentioned):
+        self.content = content
+        self.mentioned = mentioned  # tuple of open_id
+
+
+class Objective(object):
+    __slots__ = ('id', 'content', 'krs', 'has_kr', 'mentioned', 'aligned')
+
+    def __init__(self, obj_id, content, krs, has_kr, mentioned, aligned):
+        self.id = obj_id
+        self.content = content
+        self.krs = krs  # tuple of Kr
+        self.has_kr = has_kr  # False if the kr_list is missing, a healthy obj must have kr
+        self.mentioned = mentioned  # tuple of open_id, mentioned by the obj or its KRs, no duplicates
+        self.aligned = aligned  # tuple of (open_id of the owner, obj id), the child objs aligned to it
+
+
+class Okr(object):
+    __slots__ = ('objectives', 'by_id', 'avail_objs', 'no_kr')
+
+    def __init__(self, objectives):
+        self.objectives = objectives  # tuple of Objective
+        self.by_id = {obj.id: obj for obj in objectives}
+        self.avail_objs = sum(1 for obj in objectives if obj.has_kr)
+        self.no_kr = len(objectives) - self.avail_objs
+
+    def objective(self, obj_id):
+        """
+        Return:
+            Objective of the id, None if there is not
+        """
+        return self.by_id.get(obj_id)
+
+    def content(self, seg_list=()):
+        """
+        Args:
+            seg_list: List, only the Objs or KRs contain any of the segs, all of them if it is empty
+        Return:
+            String, the same content as my_utils.get_okrcontent_from_okr_str()
+        """
+        okr_content_list = []
+        for obj_number, obj in enumerate(self.objectives, 1):
+            if not seg_list or find_any_of(obj.content, seg_list):
+                okr_content_list.append('O%s: %s' % (obj_number, obj.content))
+            for kr_number, kr in enumerate(obj.krs, 1):
+                if not seg_list or find_any_of(kr.content, seg_list):
+                    okr_content_list.append('O%s->KR%s: %s' % (obj_number, kr_number, kr.content))
+        return '\n'.join(okr_content_list)
+
+
+EMPTY_OKR = Okr(())
+
+
+def _open_ids(mentioned_user_list):
+    return [mentioned['open_id'] for mentioned in mentioned_user_list or []]
+
+
+def parse_okr(okr_str):
+    """
+    Args:
+        okr_str: String, transferred from okr dict
+    Return:
+        Okr, EMPTY_OKR if okr_str is empty. Raise ValueError or KeyError if it is broken
+    """
+    if not okr_str:
+        return EMPTY_OKR
+
+    data = json.loads(okr_str, strict=False)
+    objectives = []
+    for obj in data['objective_list']:
+        krs = tuple(Kr(kr['content'], tuple(_open_ids(kr.get('mentioned_user_list'))))
+                    for kr in obj.get('kr_list') or [])
+        mentioned = _open_ids(obj.get('mentioned_user_list'))
+        for kr in krs:
+            mentioned.extend(kr.mentioned)
+        aligned = tuple((aligned_obj['owner']['open_id'], aligned_obj['id'])
+                        for aligned_obj in obj.get('aligned_objective_list') or [])
+        objectives.append(Objective(obj['id'], obj['content'], krs, 'kr_list' in obj,
+                                    tuple(dict.fromkeys(mentioned)), aligned))
+    return Okr(tuple(objectives))
+
+
+class OkrCache(object):
+    """
+    open_id => (hashcode, Okr), per process
+    """
+
+    def __init__(self):
+        self.okrs = {}
+        self.lock = threading.Lock()
+
+    def get(self, open_id, hashcode):
+        """
+        Return:
+            the Okr parsed from the raw OKR of the hashcode, None if it is not cached
+        """
+        cached = self.okrs.get(open_id)
+        if cached is not None and cached[0] == hashcode:
+            return cached[1]
+        return None
+
+    def put(self, open_id, hashcode, okr):
+        with self.lock:
+            self.okrs[open_id] = (hashcode, okr)
+        return okr
+
+    def clear(self):
+        with self.lock:
+            self.okrs = {}
+
+    def __len__(self):
+        return len(self.okrs)
@@ -1,11 +1,21 @@
 # -*- coding: utf-8 -*-
 import json
 import os
-from my_utils import my_error
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import http_client
+import profiler
+import rate_limiter
+from my_utils import my_error, my_log
 from dotenv import load_dotenv, find_dotenv
 
 # the file is to get one user's OKR URL in the feishu OKR system, which is optional to the OkrEx.
 # Instead, you can produce a new OKR display page for each user using the OKR data.
+#
+# The url ids are kept in a SQLite file, each batch of lookups is committed in one transaction, so a
+# crash never leaves a half written cache. The missing ones are looked up concurrently over the pooled
+# HTTP session, scheduled by the 'url_id' quota of rate_limiter instead of sleeping after each call.
 
 # get environmental parameter from .env files
 load_dotenv(find_dotenv())
@@ -13,12 +23,100 @@ load_dotenv(find_dotenv())
 PINGCAP_FEISHU = os.getenv("PINGCAP_FEISHU")
 PINGCAP_FEISH_HEAD = os.getenv("PINGCAP_FEISH_HEAD")
 
-# cache file to speed up, in case calling server every round of update
+# cache database to speed up, in case calling server every round of update
+URL_ID_DB = os.getenv("URL_ID_DB") if os.getenv("URL_ID_DB") else 'url_id.db'
+
+# the old JSON cache file, migrated into URL_ID_DB when it is created
 URL_ID_FILE = 'url_id.txt'
 
-url_json = {}
+# how many names are looked up in one select
+LOOKUP_CHUNK = 500
+
+store = None
+
+# the store is shared by the rebuild worker threads
+url_lock = threading.Lock()
+
+
+class UrlIdStore(object):
+    """
+    name => url id, in a SQLite file
+    """
+
+    def __init__(self, path=URL_ID_DB, legacy_file=URL_ID_FILE):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute('create table if not exists url_id (name text primary key, url_id text not null)')
+        if legacy_file and os.path.exists(legacy_file) and not self.count():
+            self.migrate(legacy_file)
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute('select count(*) from url_id').fetchone()[0]
+
+    def migrate(self, legacy_file):
+        """
+        Import the url ids from the old JSON cache file
+        """
+        try:
+            with open(legacy_file, 'r') as url_fp:
+                url_json = json.load(url_fp)
+        except Exception as e:
+            my_error(e)
+            return
+        self.put_many({name: url_id for name, url_id in url_json.items() if url_id})
+        my_log('migrated %s url ids from %s' % (self.count(), legacy_file), level='DEBUG')
+
+    def get_many(self, names):
+        """
+        Return:
+            dict, name => url id, only the names in the store
+        """
+        names = list(names)
+        found = {}
+        with self.lock:
+            for i in range(0, len(names), LOOKUP_CHUNK):
+                chunk = names[i:i + LOOKUP_CHUNK]
+                sql = 'select name, url_id from url_id where name in (%s)' % ','.join('?' * len(chunk))
+                found.update(self.conn.execute(sql, chunk).fetchall())
+        return found
+
+    def put_many(self, url_ids):
+        """
+        Args:
+            url_ids: dict, name => url id, all written in one transaction
+        """
+        if not url_ids:
+            return
+        with self.lock, self.conn:
+            self.conn.executemany('insert or replace into url_id (name, url_id) values (?, ?)',
+                                  list(url_ids.items()))
 
+    def close(self):
+        with self.lock:
+            self.conn.close()
 
+
+def get_store():
+    global store
+    with url_lock:
+        if store is None:
+            store = UrlIdStore()
+        return store
+
+
+def _headers():
+    """
+    PINGCAP_FEISH_HEAD is the curl -H argument, like 'Cookie: xxx', quoted or not
+    """
+    if not PINGCAP_FEISH_HEAD or ':' not in PINGCAP_FEISH_HEAD:
+        return {}
+    key, value = PINGCAP_FEISH_HEAD.strip().strip('\'"').split(':', 1)
+    return {key.strip(): value.strip()}
+
+
+@profiler.timed('url_id_fetch')
 def fetch_okr_url_id(name):
     """
     Args:
@@ -26,40 +124,47 @@ def fetch_okr_url_id(name):
     Return:
         The OKR url id, that can lead to the URL to the OKR page of the user
         User with same name, could return same url id by mistake. But it is very rare case.
+        '' if PINGCAP_FEISHU is not set, the url id is optional
     """
-    command = 'curl -X GET %s%s -H %s' % ( PINGCAP_FEISHU, name, PINGCAP_FEISH_HEAD)
-    print(command)
+    if not PINGCAP_FEISHU:
+        return ''
     try:
-        stream = os.popen(command)
-        content = stream.read()
-        data = json.loads(content)
+        response = rate_limiter.scheduler.call(
+            'url_id', lambda: http_client.request("GET", PINGCAP_FEISHU + name, headers=_headers()))
+        data = json.loads(response.content)
+        return data['data']['user_list'][0]['id']
     except Exception as e:
         my_error(e)
         return ''
 
-    return data['data']['user_list'][0]['id']
 
+@profiler.timed('url_id')
+def resolve_url_ids(names, workers=4):
+    """
+    Args:
+        names: List of String, see fetch_okr_url_id()
+        workers: Int, how many missing url ids are looked up concurrently
+    Return:
+        dict, name => url id, '' if it can not be found
+    """
+    url_store = get_store()
+    names = list(dict.fromkeys(names))
+    url_ids = url_store.get_many(names)
+    missing = [name for name in names if not url_ids.get(name)]
+    if not missing:
+        return url_ids
+    if not PINGCAP_FEISHU:
+        my_log('PINGCAP_FEISHU is not set, %s url ids are not looked up' % len(missing), level='DEBUG')
+        url_ids.update((name, '') for name in missing)
+        return url_ids
 
-def get_okr_url_id(name):
-    global url_json
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        fetched = dict(zip(missing, executor.map(fetch_okr_url_id, missing)))
 
-    if not url_json:
-        url_fp = open(URL_ID_FILE, 'r')
-        try:
-            url_json = json.load(url_fp)
-        except Exception:
-            pass
-        url_fp.close()
-
-    if url_json and name in url_json.keys() and url_json[name]:
-        return url_json[name]
-    else:
-        url_id = fetch_okr_url_id(name)
+    for name, url_id in fetched.items():
         if not url_id:
             my_error("Cannot get url for user %s" % name)
-        url_json[name] = url_id
-        url_fp = open(URL_ID_FILE, 'w')
-        json.dump(url_json, url_fp)
-        url_fp.close()
-        return url_id
+    url_store.put_many({name: url_id for name, url_id in fetched.items() if url_id})
 
+    url_ids.update(fetched)
+    return url_ids
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+import getopt
+import re
+import sys
+from collections import Counter
+
+import jieba
+
+import my_seg
+import my_utils
+import talk2Tidb
+
+# The file builds the organisation vocabulary, a jieba user dictionary of the product names, team names
+# and jargon in our OKRs, which the default dictionary splits into fragments.
+#
+# The candidates are the n-grams of adjacent jieba tokens with at least one fragment, a single Chinese
+# character token, e.g. 飞书妙 + 记. They must appear in the OKRs of enough users and hang together, i.e. most of
+# the times their rarest part appears, it is inside the n-gram. Only the n-grams having a part indexed in
+# key2user are kept, the others do not change the index. Once a word is taken, the candidates containing it
+# or contained by it are skipped, so one name is not learned in several overlapping pieces.
+#
+# Usage:
+#   python3 okr_vocab.py -o userdict.txt [-n <max words>] [-c <min users>]
+# then set USER_DICT=userdict.txt in the .env file. It prints the index size before and after.
+
+# a token that jieba can put into a dictionary word, see jieba.re_han_default
+WORD_TOKEN = re.compile(r'^[一-鿕a-zA-Z0-9+#&\._%\-]+$')
+# a single Chinese character token, usually a fragment of a word jieba does not know
+FRAGMENT = re.compile(r'^[一-鿕]$')
+
+
+def load_okr_corpus(db):
+    """
+    Return:
+        List of String, the OKR content of each user
+    """
+    texts = []
+    for okr_str, in talk2Tidb.get_all_from_tbl_by_cols(db, 'users', ('okr',)):
+        okr_content, nil, nil = my_utils.get_okrcontent_from_okr_str(okr_str)
+        if okr_content:
+            texts.append(okr_content)
+    return texts
+
+
+def load_indexed_segs(db):
+    """
+    Return:
+        dict, seg => how many users mention it, from key2user
+    """
+    return {seg: freq for seg, freq in talk2Tidb.get_all_from_tbl_by_cols(db, 'key2user', ('seg', 'freq'))}
+
+
+def _token_runs(text):
+    """
+    Split the jieba tokens of text into runs of adjacent word tokens, the punctuations and blanks break the runs
+    """
+    run = []
+    for token in jieba.lcut(text):
+        if WORD_TOKEN.match(token):
+            run.append(token)
+        else:
+            if len(run) > 1:
+                yield run
+            run = []
+    if len(run) > 1:
+        yield run
+
+
+def mine_vocabulary(texts, indexed_segs, max_words=2000, min_users=3, max_n=3, cohesion=0.5):
+    """
+    Args:
+        texts: List of String, one OKR content per user
+        indexed_segs: dict, seg => freq in key2user
+        max_words: Int, at most how many words are returned
+        min_users: Int, an n-gram must appear in the OKRs of so many users
+        max_n: Int, the longest n-gram in tokens
+        cohesion: float, the n-gram count divided by the count of its rarest part must be at least it
+    Return:
+        List of (word, count), the most frequent first
+    """
+    stop_words = my_seg.load_stop_words()
+    token_count = Counter()
+    ngram_count = Counter()
+    ngram_users = Counter()
+    ngram_parts = {}
+
+    for text in texts:
+        seen = set()
+        for run in _token_runs(text):
+            token_count.update(run)
+            for n in range(2, max_n + 1):
+                for i in range(len(run) - n + 1):
+                    parts = run[i:i + n]
+                    if any(p.lower() in stop_words for p in parts):
+                        continue
+                    if not any(FRAGMENT.match(p) for p in parts):
+                        continue
+                    word = ''.join(parts)
+                    ngram_count[word] += 1
+                    ngram_parts[word] = parts
+                    seen.add(word)
+        ngram_users.update(seen)
+
+    candidates = []
+    for word, count in ngram_count.items():
+        if ngram_users[word] < min_users:
+            continue
+        parts = ngram_parts[word]
+        if count < cohesion * min(token_count[p] for p in parts):
+            continue
+        if not any(p.lower() in indexed_segs for p in parts):
+            continue
+        candidates.append((word, count, len(parts)))
+
+    # the most frequent first, the shorter one first for the same count
+    candidates.sort(key=lambda c: (-c[1], c[2], c[0]))
+
+    words = []
+    for word, count, n in candidates:
+        if len(words) >= max_words:
+            break
+        if any(word in taken or taken in word for taken, nil in words):
+            continue
+        words.append((word, count))
+    return words
+
+
+def write_user_dict(words, path):
+    """
+    Write words in the jieba user dictionary format, one "word freq" a line.
+    The freq is raised to what jieba needs to keep the word in one piece.
+    """
+    with open(path, 'w', encoding='utf-8') as f:
+        for word, count in words:
+            f.write('%s %s\n' % (word, max(count, jieba.suggest_freq(word))))
+
+
+def index_size(texts):
+    """
+    Return:
+        (how many distinct segs, how many (seg, user) postings) when texts are segmented now
+    """
+    segs = set()
+    postings = 0
+    for seg_dict in my_seg.seg_many(texts, workers=1):
+        segs.update(seg_dict)
+        postings += len(seg_dict)
+    return len(segs), postings
+
+
+def build(path, max_words=2000, min_users=3):
+    """
+    Mine the vocabulary with the default jieba dictionary, and compare the index size by the default
+    dictionary (before) with the one by the new user dictionary (after). An existing USER_DICT is left out.
+    """
+    my_seg.warm_up(user_dict=False)
+
+    db = talk2Tidb.connect_tidb_okr()
+    texts = load_okr_corpus(db)
+    indexed_segs = load_indexed_segs(db)
+    talk2Tidb.close_tidb_okr(db)
+
+    words = mine_vocabulary(texts, indexed_segs, max_words=max_words, min_users=min_users)
+    write_user_dict(words, path)
+
+    report = ['%s words are written into %s' % (len(words), path),
+              'key2user now: %s segs, %s postings' % (len(indexed_segs), sum(indexed_segs.values()))]
+
+    before = index_size(texts)
+    jieba.load_userdict(path)
+    after = index_size(texts)
+
+    report.append('before: %s segs, %s postings' % before)
+    report.append('after: %s segs, %s postings' % after)
+    for line in report:
+        print(line)
+        my_utils.my_log(line, level='DEBUG')
+
+
+def main(argv):
+    usage = 'okr_vocab.py -o <user dict file> -n <max words> -c <min users>'
+    try:
+        opts, args = getopt.getopt(argv, "ho:n:c:")
+    except getopt.GetoptError:
+        print(usage)
+        sys.exit(2)
+
+    path = ''
+    max_words = 2000
+    min_users = 3
+    try:
+        for opt, arg in opts:
+            if opt == '-h':
+                print(usage)
+                sys.exit()
+            elif opt == '-o':
+                path = arg
+            elif opt == '-n':
+                max_words = int(arg)
+            elif opt == '-c':
+                min_users = int(arg)
+    except ValueError:
+        print('only integer is allowed after -n and -c')
+        sys.exit(2)
+
+    if not path:
+        print(usage)
+        sys.exit(2)
+
+    build(path, max_words, min_users)
+
+
+if __name__ == "__main__":
+    my_utils.init_log('okr_vocab.log', level='DEBUG')
+    main(sys.argv[1:])
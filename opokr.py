@@ -7,10 +7,16 @@ import getopt
 import os
 import my_utils
 from dotenv import load_dotenv, find_dotenv
-import requests
+import http_client
 import json
 import okr_url_id
 import my_seg
+import checkpoint
+import my_pipeline
+import org_tree
+import profiler
+import similarity
+import seg_cache
 import hashlib
 
 # get environmental parameter from .env files
@@ -21,32 +27,81 @@ SBSCRB_CHK_INTERVAL = os.getenv("SBSCRB_CHK_INTERVAL")  # str type, in hours
 SEGS_CHANGED = os.getenv("SEGS_CHANGED")
 # RELEVANCY = os.getenv("RELEVANCY")
 RELEVANCY = '10'  # hard code 10 so far
+# how many url_id lookups can be in flight during the users rebuild
+URL_ID_WORKERS = int(os.getenv("URL_ID_WORKERS") if os.getenv("URL_ID_WORKERS") else '4')
+# how many users are segmented and written as a batch during the users rebuild
+PIPELINE_BATCH = int(os.getenv("PIPELINE_BATCH") if os.getenv("PIPELINE_BATCH") else '100')
+# the progress of the running rebuild, a broken rebuild is resumed from it if it is younger than the TTL in hours
+REBUILD_CHECKPOINT = os.getenv("REBUILD_CHECKPOINT") if os.getenv("REBUILD_CHECKPOINT") else 'rebuild_checkpoint.json'
+REBUILD_CHECKPOINT_TTL = int(os.getenv("REBUILD_CHECKPOINT_TTL") if os.getenv("REBUILD_CHECKPOINT_TTL") else '24')
+# the interval in minutes of the incremental refresh between two rebuilds, 0 means no incremental refresh
+REFRESH_INTERVAL = int(os.getenv("REFRESH_INTERVAL") if os.getenv("REFRESH_INTERVAL") else '0')
+# a refresh does not delete more than this fraction of the users, the rebuild does
+REFRESH_MAX_GONE = 0.1
 
 interval = int(SBSCRB_CHK_INTERVAL)  # the subscribe key table checking interval in hours
 
 
-def cal_avail_okr_count_by_dep(db, dep_id):
+def load_users_health(db):
+    """
+    Return:
+        dict, open_id => (objective count, count of the objectives without KR), from the users table in one query
+    """
+    cols = ('open_id', 'avail_obj', 'obj_nokr')
+    return {tup[0]: (int(tup[1]), int(tup[2]))
+            for tup in talk2Tidb.get_all_from_tbl_by_cols(db, 'users', cols) if tup and tup[0]}
+
+
+def collect_dep_users(children, members, dep_ids, root="0"):
+    """
+    Aggregate the users bottom-up over the department tree in one post-order walk.
+    Args:
+        children: dict, open_department_id => List of the direct child department ids
+        members: dict, open_department_id => List of the open id of the direct members
+        dep_ids: the departments whose users are wanted, the other sets are freed once merged into the parent
+    Return:
+        dict, open_department_id in dep_ids => set of the open id of all the users in it and its sub departments
+    """
+    wanted = set(dep_ids)
+    users = {}
+    result = {}
+    stack = [(root, False)]
+    while stack:
+        dep_id, visited = stack.pop()
+        if not visited:
+            stack.append((dep_id, True))
+            for child in children.get(dep_id, []):
+                stack.append((child, False))
+            continue
+
+        dep_users = set(members.get(dep_id, []))
+        for child in children.get(dep_id, []):
+            dep_users |= users.pop(child, set())
+        users[dep_id] = dep_users
+        if dep_id in wanted:
+            result[dep_id] = set(dep_users)
+    return result
+
+
+def cal_avail_okr_count_by_dep(health, user_list, dep_id):
     """
     Return the count of avail okr in the department dep_id
     Available means a guy who has more than one objective is set.
+    Args:
+        health: dict, see load_users_health()
+        user_list: all the users in the department, see collect_dep_users()
     """
-    user_list = get_data_from_feishu.get_all_users_in_dep(dep_id)
-
     my_utils.my_log('user number is %s' % len(user_list), level='DEBUG')
 
     avail = 0
 
     not_health_user_id_list = []
 
-    cols = ('open_id', 'avail_obj', 'obj_nokr')
-
-    for user in user_list:
-        tup = talk2Tidb.get_one_from_tbl_by_cols_with_openid(db, 'users', cols, user)
-        if not tup or not tup[0]:
+    for user in sorted(user_list):
+        if user not in health:
             my_utils.my_error('empty tup,user is %s, depart is %s' % (user, dep_id))
             continue
-        objs = int(tup[0][1])
-        no_kr = int(tup[0][2])
+        objs, no_kr = health[user]
         if objs > 0 and no_kr <= 0:  # objs = 0 or no_kr >0 are unhealthy
             avail += 1
         else:
@@ -54,6 +109,7 @@ def cal_avail_okr_count_by_dep(db, dep_id):
     return avail, not_health_user_id_list
 
 
+@profiler.timed('department_health')
 def build_departments_tbl():
     """
       desc departments;
@@ -80,44 +136,127 @@ def build_departments_tbl():
 
     tbl_alike = talk2Tidb.create_tbl_alike(db, tbl_name)
 
-    first_level_dep = get_data_from_feishu.get_all_direct_child_departs("0")
-
-    for fld in first_level_dep:
-        if 'leader_user_id' in fld.keys():  # exclude those virtual departments
-            avail_okr_count, not_health_user_id_list = cal_avail_okr_count_by_dep(db, fld['open_department_id'])
-            sql = "insert into %s (%s) values('%s','%s','%s',1,%s,%s,'%s','%s')" \
-                  % (tbl_alike, cols_name, fld['open_department_id'],
-                     fld['name'], fld['leader_user_id'], fld['member_count'], avail_okr_count,
-                     ';'.join(not_health_user_id_list),
-                     fld['parent_department_id'])
-            talk2Tidb.query_tidb_okr(db, sql)
-
-    second_level_departments = get_data_from_feishu.get_all_second_level_departs()
-
-    for dep in second_level_departments:
-        if 'leader_user_id' in dep.keys():
-            avail_okr_count, not_health_user_id_list = cal_avail_okr_count_by_dep(db, dep['open_department_id'])
-            sql = "insert into %s (%s) values('%s','%s','%s',2,%s,%s,'%s','%s')" \
-                  % (tbl_alike, cols_name, dep['open_department_id'],
-                     dep['name'], dep['leader_user_id'], dep['member_count'], avail_okr_count,
-                     ';'.join(not_health_user_id_list),
-                     dep['parent_department_id'])
-            talk2Tidb.query_tidb_okr(db, sql)
+    writer = talk2Tidb.BulkWriter(db, tbl_alike, cols=cols_name, verb='insert')
+
+    # the tree, the members and the users health are all loaded once, then aggregated bottom-up
+    # the users fetch of the same rebuild has left the snapshot, so usually no Feishu call is needed here
+    tree = get_data_from_feishu.get_org_tree()
+    health = load_users_health(db)
+
+    # exclude those virtual departments without leader
+    first_level_dep = [dep for dep in tree.direct_children(org_tree.ROOT) if 'leader_user_id' in dep.keys()]
+    second_level_departments = [dep for dep in get_data_from_feishu.get_all_second_level_departs()
+                                if 'leader_user_id' in dep.keys()]
+
+    dep_users = collect_dep_users(tree.children, tree.members,
+                                  [dep['open_department_id'] for dep in first_level_dep + second_level_departments])
+
+    for level, deps in ((1, first_level_dep), (2, second_level_departments)):
+        for dep in deps:
+            avail_okr_count, not_health_user_id_list = cal_avail_okr_count_by_dep(
+                health, dep_users[dep['open_department_id']], dep['open_department_id'])
+            writer.add("('%s','%s','%s',%s,%s,%s,'%s','%s')"
+                       % (dep['open_department_id'],
+                          dep['name'], dep['leader_user_id'], level, dep['member_count'], avail_okr_count,
+                          ';'.join(not_health_user_id_list),
+                          dep['parent_department_id']))
+    writer.close()
     talk2Tidb.drop_tbl(db, tbl_name)
     talk2Tidb.rn_tbl(db, tbl_alike, tbl_name)
     talk2Tidb.close_tidb_okr(db)
 
 
-def _get_item(p, t):
-    for i in t:
-        if p == i[0]:
-            return i
-        else:
+def _key2user_key(seg):
+    """
+    All stored keys are lowercase and without '
+    """
+    return seg.lower().replace("'", "")
+
+
+def _key2user_ops(tup_old, tup_new, users_id_disappeared, users_id_new, users_id_may_changed):
+    """
+    Return:
+        List of (add, key, open_id, num), the changes to apply on key2user, in the order they are applied.
+        add is True to add num to the open_id under the key, False to remove the open_id from the key
+    """
+    old_by_id = {t[0]: t for t in tup_old}
+    new_by_id = {t[0]: t for t in tup_new}
+    ops = []
+
+    for user_id in users_id_disappeared:
+        user = old_by_id[user_id]
+        my_utils.my_log('user %s disappeared' % user[1], level='DEBUG')
+        for seg, value in json.loads(user[2]).items():
+            if seg:
+                ops.append((False, _key2user_key(seg), user[0], value))
+
+    for user_id in users_id_new:
+        user = new_by_id[user_id]
+        my_utils.my_log('user %s added' % user[1], level='DEBUG')
+        for seg, value in json.loads(user[2]).items():
+            if seg:
+                ops.append((True, _key2user_key(seg), user[0], value))
+
+    # handle the change ones by the hashcode
+    for user_id in users_id_may_changed:
+        user_old = old_by_id[user_id]
+        user_new = new_by_id[user_id]
+        if user_old[3] == user_new[3]:  # the same hashcode, content not changed
+            continue
+        my_utils.my_log('there are change for user %s' % user_id, level='DEBUG')
+        new_segs_dict = json.loads(user_new[2])
+        old_segs_dict = json.loads(user_old[2])
+
+        for seg in set(new_segs_dict) - set(old_segs_dict):
+            if seg:
+                ops.append((True, _key2user_key(seg), user_id, new_segs_dict[seg]))
+
+        for seg in set(old_segs_dict) - set(new_segs_dict):
+            if seg:
+                ops.append((False, _key2user_key(seg), user_id, old_segs_dict[seg]))
+
+        # there are some segs, which freq changed, we also should update for them
+        for seg in set(new_segs_dict) & set(old_segs_dict):
+            if new_segs_dict[seg] != old_segs_dict[seg]:
+                ops.append((True, _key2user_key(seg), user_id, new_segs_dict[seg]))
+
+    return [op for op in ops if op[1]]  # the key could be empty after removing '
+
+
+def _apply_key2user_ops(postings, ops):
+    """
+    Args:
+        postings: dict, key => {open_id: num}, the current key2user entries the ops touch, updated in place
+        ops: see _key2user_ops()
+    Return:
+        dict, key => howchanged ('add', 'update' or 'delete') for the keys changed
+    """
+    howchanged = {}
+    for add, key, open_id, num in ops:
+        if key not in postings:
+            if add:
+                postings[key] = {open_id: num}
+                howchanged[key] = 'add'
+            else:
+                my_utils.my_error("Trying to remove a user %s from a unrelated key %s" % (open_id, key))
             continue
-    return ()
 
+        open_id_dict = postings[key]
+        if add:
+            if open_id in open_id_dict:
+                open_id_dict[open_id] += num
+            else:
+                open_id_dict[open_id] = num
+        elif open_id in open_id_dict:
+            del open_id_dict[open_id]
+
+        # the key no longer has any open_id, we will keep it for a while and delete it later
+        howchanged[key] = 'update' if open_id_dict else 'delete'
+    return howchanged
 
-def update_key2user_tbl_with_users_change(db, users_alike, key2user_alike=''):
+
+@profiler.timed('key2user_diff')
+def update_key2user_tbl_with_users_change(db, users_alike, key2user_alike='', ckpt=None):
     """
     Args:
         db, the connector
@@ -143,20 +282,44 @@ def update_key2user_tbl_with_users_change(db, users_alike, key2user_alike=''):
        For each of set(segs-), we remove open_id from the seg's open_id list.
        If the open_id list is empty, we need delete the entry from the table.
 
-       The process should be atomic. Should use a tmeproary file to keep set(segs+) and set(segs-)
-        until 3) is finished
+    The changes are applied in memory on the entries they touch, grouped by seg,
+    then written back in a few multi-row upserts.
+    In the posting storage mode, only the changed rows of key2user_posting are written.
+
+    The changes are computed into a plan first, it is kept by ckpt before it is written,
+    so after a crash the same writes are replayed instead of applying the changes twice.
+    """
+    plan = ckpt.load_plan('key2user') if ckpt else None
+    if plan is None:
+        plan = plan_key2user_change(db, users_alike, key2user_alike)
+        if ckpt:
+            ckpt.save_plan('key2user', plan)
+    else:
+        my_utils.my_log('replay the key2user plan of %s keys' % len(plan['howchanged']), level='DEBUG')
+    apply_key2user_plan(db, plan)
+
+
+def plan_key2user_change(db, users_alike, key2user_alike=''):
+    """
+    Return:
+        dict, the writes to apply on key2user, see update_key2user_tbl_with_users_change()
+        tbl: the key2user table to write
+        soft: Boolean, the existing key2user is changed in place
+        posting: Boolean, the postings are kept in the posting table
+        howchanged: dict, seg => 'add', 'update' or 'delete'
+        postings: dict, seg => {open_id: num}, the new postings of the changed segs
+        old_postings: dict, seg => {open_id: num}, the postings of the changed segs before, posting mode only
     """
 
     cols = ('open_id', 'name', 'segs', 'hashcode')
     tup_new = talk2Tidb.get_all_from_tbl_by_cols(db, users_alike, cols)
     tup_new_id_list = [t[0] for t in tup_new]
     if key2user_alike:
+        tup_old = ()
         tup_old_id_list = []
     else:  # if key2user_alike is '' means it is a soft way, compare to existing users table
         tup_old = talk2Tidb.get_all_from_tbl_by_cols(db, 'users', cols)
         tup_old_id_list = [t[0] for t in tup_old]
-        # clear the howhanged value in key2user table in the soft mode
-        talk2Tidb.clear_howchanged(db, 'key2user')
 
     users_id_disappeared = set(tup_old_id_list) - set(tup_new_id_list)
     my_utils.my_log('user disappear', level='DEBUG')
@@ -166,81 +329,58 @@ def update_key2user_tbl_with_users_change(db, users_alike, key2user_alike=''):
     my_utils.my_log('user may changed', level='DEBUG')
     my_utils.my_log(users_id_may_changed, level='DEBUG')
 
-    for user_id in users_id_disappeared:
-        user = _get_item(user_id, tup_old)
-        my_utils.my_log('user %s disappeared' % user[1], level='DEBUG')
-        for seg,value in json.loads(user[2]).items():
-            if seg:
-                # handle the seg as remove
-                talk2Tidb.update_tidb_key2user_by_key(db=db,
-                                                      key=seg,
-                                                      open_id=user[0],
-                                                      num=value,
-                                                      add=False,
-                                                      obj=False)
-    for user_id in users_id_new:
-        user = _get_item(user_id, tup_new)
-        my_utils.my_log('user %s added' % user[1], level='DEBUG')
-        # for seg in user[2].split(';'):
-        for seg, value in json.loads(user[2]).items():
-            if seg:
-                if key2user_alike:
-                    talk2Tidb.build_key2user_by_key(db=db,
-                                                    tbl=key2user_alike,
-                                                    key=seg,
-                                                    open_id=user[0],
-                                                    num=value)
-                else:
-                    # handle the seg as new add
-                    talk2Tidb.update_tidb_key2user_by_key(db=db,
-                                                          key=seg,
-                                                          open_id=user[0],
-                                                          num=value,
-                                                          add=True,
-                                                          obj=False)
-    # handle the change ones by the hashcode
-    for user_id in users_id_may_changed:
-        user_old = _get_item(user_id, tup_old)
-        user_new = _get_item(user_id, tup_new)
-        if user_old[3] != user_new[3]:  # hashcode are different, content changed
-            my_utils.my_log('there are change for user %s' % user_id, level='DEBUG')
-            new_segs_dict = json.loads(user_new[2])
-            old_segs_dict = json.loads(user_old[2])
-            added_segs_set = set(new_segs_dict) - set(old_segs_dict)
-
-            for seg in added_segs_set:
-                if seg:
-                    talk2Tidb.update_tidb_key2user_by_key(db=db,
-                                                          key=seg,
-                                                          open_id=user_id,
-                                                          num=new_segs_dict[seg],
-                                                          add=True,
-                                                          obj=False)
-
-            disappeared_segs_set = set(old_segs_dict) - set(new_segs_dict)
-            for seg in disappeared_segs_set:
-                if seg:
-                    talk2Tidb.update_tidb_key2user_by_key(db=db,
-                                                          key=seg,
-                                                          open_id=user_id,
-                                                          num = old_segs_dict[seg],
-                                                          add=False,
-                                                          obj=False)
-
-            # there are some segs, which freq changed, we also should update for them
-
-            keep_segs_set = set(new_segs_dict) & set(old_segs_dict)
-
-            for seg in keep_segs_set:
-                if new_segs_dict[seg] == old_segs_dict[seg]:
-                    pass
-                else: # freq changed
-                    talk2Tidb.update_tidb_key2user_by_key(db=db,
-                                                          key=seg,
-                                                          open_id=user_id,
-                                                          num=new_segs_dict[seg],
-                                                          add=True,
-                                                          obj=False)
+    ops = _key2user_ops(tup_old, tup_new, users_id_disappeared, users_id_new, users_id_may_changed)
+
+    return plan_key2user_ops(db, ops, key2user_alike)
+
+
+def plan_key2user_ops(db, ops, key2user_alike=''):
+    """
+    Args:
+        ops: see _key2user_ops()
+        key2user_alike: the new key2user table built from empty, '' to change key2user in place
+    Return:
+        the plan, see plan_key2user_change()
+    """
+    tbl = key2user_alike if key2user_alike else 'key2user'
+    keys = set(op[1] for op in ops)
+    posting_mode = talk2Tidb.KEY2USER_STORAGE == 'posting'
+
+    if key2user_alike:  # build from empty
+        postings = {}
+    elif posting_mode:
+        # a missing posting table reads as no postings at all, every key would be rewritten as new
+        if not talk2Tidb.tbl_exists(db, talk2Tidb.posting_tbl_of(tbl)):
+            raise RuntimeError('%s does not exist, run `python3 opokr.py -m` to migrate %s before using '
+                               'KEY2USER_STORAGE=posting' % (talk2Tidb.posting_tbl_of(tbl), tbl))
+        postings = talk2Tidb.get_postings_by_keys(db, talk2Tidb.posting_tbl_of(tbl), keys)
+    else:
+        postings = talk2Tidb.get_key2user_by_keys(db, tbl, keys)
+
+    old_postings = {key: dict(value) for key, value in postings.items()} if posting_mode else {}
+
+    howchanged = _apply_key2user_ops(postings, ops)
+
+    my_utils.my_log('%s changes on %s keys of %s' % (len(ops), len(howchanged), tbl), level='DEBUG')
+
+    return {'tbl': tbl, 'soft': not key2user_alike, 'posting': posting_mode, 'howchanged': howchanged,
+            'postings': {key: postings[key] for key in howchanged if key in postings},
+            'old_postings': {key: old_postings[key] for key in howchanged if key in old_postings}}
+
+
+def apply_key2user_plan(db, plan):
+    """
+    Write the plan of plan_key2user_change(), the writes set the final values, so it can be applied again
+    """
+    if plan['soft']:
+        # clear the howhanged value in key2user table in the soft mode
+        talk2Tidb.clear_howchanged(db, 'key2user')
+
+    tbl = plan['tbl']
+    talk2Tidb.upsert_key2user(db, tbl, plan['postings'], plan['howchanged'], with_list=not plan['posting'])
+    if plan['posting']:  # only the changed postings are touched
+        talk2Tidb.update_postings(db, talk2Tidb.posting_tbl_of(tbl), plan['old_postings'], plan['postings'],
+                                  plan['howchanged'])
 
 
 def update_okr_server_msg_tbl(db):
@@ -289,49 +429,160 @@ def segs_relevancy(base_segs, comp_segs):
     return len(inter_set) * 0.7 + comp_freq/base_freq
 
 
-def insert_relevency(top_rel, open_id, relevancy):
+@profiler.timed('top_related')
+def cal_top_related(db, users_alike, open_ids=None):
     """
+    Cal the top RELEVANCY (at most) who highly related to each user.
+    Each user is compared with all the others, only the users sharing at least one seg are scored.
+    See similarity.py
     Args:
-        top_rel, List of the tuples, each tup is (open_id, relevancey).
-        Only save the top RELEVANCY pair
-    """
-    tup1 = (open_id, relevancy)
-    if len(top_rel) == 0:
-        top_rel.append(tup1)
-    else:
-        for index in range(len(top_rel) if len(top_rel) < int(RELEVANCY) else int(RELEVANCY)):
-            if relevancy < top_rel[index][1]:
-                continue
-        if index < int(RELEVANCY) - 1:
-            top_rel.insert(index, tup1)
-
-
-def cal_top_related(db, users_alike):
-    """
-    Cal the top 10 (at most) who highly related to each user
-    It is N*N time complexity
+        open_ids: only recalculate these users, None means all the users
     """
     cols = ('open_id', 'segs')
     tup = talk2Tidb.get_all_from_tbl_by_cols(db, users_alike, cols)
 
-    for index in range(len(tup)):
-        top_rel = []  # at most 10 elements, each is a tuple (open_id, relevancy)
-        cursor = index + 1
-        while cursor < len(tup):
-            relevancy = segs_relevancy(tup[index][1], tup[cursor][1])
-            if relevancy > 0.0:
-                insert_relevency(top_rel, tup[cursor][0], relevancy)
-            cursor += 1
-
-        if top_rel:
-            top_rel_open_id = ';'.join([t[0] for t in top_rel])
+    rows = None
+    if open_ids is not None:
+        rows = [index for index, t in enumerate(tup) if t[0] in open_ids]
+
+    top_related_list = []  # (open_id, top related open ids delimiter with ;)
+
+    for index, top in similarity.iter_top_related([t[1] for t in tup], int(RELEVANCY), rows=rows):
+        if top:
+            top_rel_open_id = ';'.join([tup[cursor][0] for cursor, relevancy in top])
             my_utils.my_log('top related is %s for user %s' % (top_rel_open_id, tup[index][0]), level='DEBUG')
-            talk2Tidb.update_users_by_open_id(db, users_alike, tup[index][0], top_rel_open_id)
+            top_related_list.append((tup[index][0], top_rel_open_id))
         else:
             my_utils.my_log('has not found related user for %s' % tup[index][0], level='DEBUG')
+            if open_ids is not None:  # clear the old ones
+                top_related_list.append((tup[index][0], ''))
+
+    talk2Tidb.update_top_related(db, users_alike, top_related_list)
+
+
+def _okr_stage(users):
+    """
+    Args:
+        users: iterable of Feishu user dicts
+    Return:
+        generator of (user, okr_dict), the OKRs are fetched by FEISHU_WORKERS threads
+    """
+    in_flight = {}  # bounded by the pending users of iter_latest_okrs
 
+    def open_ids():
+        for user in users:
+            in_flight[user['open_id']] = user
+            yield user['open_id']
 
-def update_user_tbl_from_feishu(mode):
+    for open_id, okr_dict in get_data_from_feishu.iter_latest_okrs(open_ids()):
+        yield in_flight.pop(open_id), okr_dict
+
+
+def _url_id_stage(pairs):
+    """
+    Return:
+        generator of (user, okr_dict, url_id), the url ids are resolved a batch at a time, the missing ones
+        are looked up by URL_ID_WORKERS threads
+    """
+    for batch in my_pipeline.batched(pairs, PIPELINE_BATCH):
+        # email depends on how many privileges you got
+        url_ids = okr_url_id.resolve_url_ids([user['email'] for user, okr_dict in batch], URL_ID_WORKERS)
+        for user, okr_dict in batch:
+            url_id = url_ids[user['email']]
+            if not url_id or not url_id.isdigit():
+                my_utils.my_log('url_id is %s for user %s' % (url_id, user['name']), level='DEBUG')
+            yield user, okr_dict, url_id
+
+
+def _build_user_row(user, okr_dict, url_id):
+    """
+    Return:
+        (row, okr_content), row is a dict of the user_entry_values() arguments except segs and hashcode
+    """
+    try:
+        leader = user['leader_user_id']
+    except KeyError:
+        leader = ''  # the top manager has no the key and contractor has no the key
+
+    avail_obj, obj_nokr = my_utils.cal_avail_obj_by_okr_dict(okr_dict)
+
+    okr_str = json.dumps(okr_dict, ensure_ascii=False)  # in case of the Chinese mess
+
+    okr_content, nil, nil = my_utils.get_okrcontent_from_okr_str(okr_str)
+
+    okr_str = okr_str.replace('\\', '\\\\')  # mysql will eat \, need change it to be \\
+
+    okr_str = okr_str.replace("'", "\\'")  # okr_str cannot have ', will affect sql insert, change it to be \'
+
+    row = {'open_id': user['open_id'],
+           'okr_str': okr_str,
+           'name': user['name'],
+           'url_id': url_id,
+           'email': user['email'],
+           'en_name': user['en_name'],
+           'leader': leader,
+           'avatar': user['avatar']['avatar_72'],
+           'avail_obj': avail_obj,
+           'obj_nokr': obj_nokr,
+           'hasupdate': 0}
+    return row, okr_content
+
+
+def _segment_stage(triples, cache):
+    """
+    Args:
+        triples: iterable of (user, okr_dict, url_id)
+        cache: seg_cache.SegCache, the OKRs already in it are not segmented again
+    Return:
+        generator of the complete user rows, segmented PIPELINE_BATCH users at a time by SEG_WORKERS processes
+    """
+    for batch in my_pipeline.batched(triples, PIPELINE_BATCH):
+        built = [_build_user_row(user, okr_dict, url_id) for user, okr_dict, url_id in batch]
+
+        hashcodes = [hashlib.md5(okr_content.encode('utf-8')).hexdigest() for row, okr_content in built]
+
+        segs_list = [cache.get(hashcode) for hashcode in hashcodes]
+
+        # only the changed OKRs are segmented, by the process pool of my_seg
+        todo = [i for i in range(len(built)) if segs_list[i] is None]
+        with profiler.stage('segmentation'):
+            seg_dicts = my_seg.seg_many([built[i][1] for i in todo])
+
+        for i, seg_dict in zip(todo, seg_dicts):
+            segs_list[i] = json.dumps(seg_dict, ensure_ascii=False)
+            cache.put(hashcodes[i], segs_list[i])
+
+        for (row, okr_content), segs, hashcode in zip(built, segs_list, hashcodes):
+            row['segs'] = segs
+
+            row['hashcode'] = hashcode
+
+            yield row
+
+
+def _write_stage(db, tbl, rows, ckpt):
+    """
+    Write the user rows into the tbl, in multi-row statements.
+    Each statement is a committed batch, it is counted by ckpt right after.
+    Return:
+        Int, how many rows are written
+    """
+    counted = 0
+    with talk2Tidb.BulkWriter(db, tbl) as writer:
+        for row in rows:
+            if row['open_id']:
+                flushes = writer.flushes
+                writer.add(talk2Tidb.user_entry_values(**row))
+                if writer.flushes != flushes:
+                    ckpt.batch_done(writer.written - counted)
+                    counted = writer.written
+    if writer.written != counted:
+        ckpt.batch_done(writer.written - counted)
+    my_utils.my_log('wrote %s rows into %s in %s flushes' % (writer.written, tbl, writer.flushes), level='DEBUG')
+    return writer.written
+
+
+def update_user_tbl_from_feishu(mode, ckpt=None):
     """
     update the users table through source of Feishu
 
@@ -356,117 +607,260 @@ def update_user_tbl_from_feishu(mode):
 
     Notice:
     The function can be called repeatedly
+    With ckpt, the stages finished by a broken rebuild are skipped, and the users already in the
+    shadow users table are not fetched again.
 
     """
-    user_list = get_data_from_feishu.get_all_user_dict_from_feishu()
+    if ckpt is None:
+        ckpt = checkpoint.Checkpoint(mode=mode)
 
     db = talk2Tidb.connect_tidb_okr()
 
-    users_alike = talk2Tidb.create_tbl_alike(db, 'users')
+    users_alike = talk2Tidb.tbl_alike_of('users')
+    key2user_alike = talk2Tidb.tbl_alike_of('key2user') if mode == 'hard' else ''
+
+    if not ckpt.done('users'):
+        done_ids = set()
+        if ckpt.started('users') and talk2Tidb.tbl_exists(db, users_alike):
+            done_ids = set(t[0] for t in talk2Tidb.get_all_from_tbl_by_cols(db, users_alike, ('open_id',),
+                                                                          strict=True))
+            my_utils.my_log('resume %s with %s users done' % (users_alike, len(done_ids)), level='DEBUG')
+        else:
+            _create_shadow_tbls(db, mode)
+            ckpt.start('users')
+
+        # fetch => OKR => url_id => segment => write, the stages are generators chained together.
+        # The network stages run in their own worker threads, so they keep working while the main thread
+        # segments and writes. Each stage only takes a bounded number of users ahead of the next one.
+        cache = seg_cache.SegCache(version=my_seg.dict_fingerprint())
+        users = (user for user in get_data_from_feishu.iter_all_user_dicts_from_feishu()
+                 if user['open_id'] not in done_ids)
+        rows = _segment_stage(_url_id_stage(_okr_stage(users)), cache)
+        written = _write_stage(db, users_alike, rows, ckpt)
+        my_utils.my_log('%s users are written into %s' % (written, users_alike), level='DEBUG')
+        cache.log_stats()
+        cache.save()
+        ckpt.finish('users')
+
+    # Finished writing new table
+
+    # start comparing the new users tbl and old one to decide which user is updated
+    if not ckpt.done('key2user'):
+        update_key2user_tbl_with_users_change(db, users_alike, key2user_alike, ckpt)
+        ckpt.finish('key2user')
+
+    if not ckpt.done('top_related'):
+        cal_top_related(db, users_alike)
+        ckpt.finish('top_related')
+
+    if not ckpt.done('swap'):
+        _swap_tbl(db, users_alike, 'users')
+        if mode == 'hard':
+            _swap_tbl(db, key2user_alike, 'key2user')
+            if talk2Tidb.KEY2USER_STORAGE == 'posting':
+                _swap_tbl(db, talk2Tidb.posting_tbl_of(key2user_alike), 'key2user_posting')
+        ckpt.finish('swap')
+
+    if not ckpt.done('server_msg'):
+        update_okr_server_msg_tbl(db)
+        ckpt.finish('server_msg')
+    talk2Tidb.close_tidb_okr(db)
+
+
+def _create_shadow_tbls(db, mode):
+    talk2Tidb.create_tbl_alike(db, 'users')
     if mode == 'hard':
-        key2user_alike = talk2Tidb.create_tbl_alike(db, 'key2user')
+        talk2Tidb.create_tbl_alike(db, 'key2user')
+        if talk2Tidb.KEY2USER_STORAGE == 'posting':
+            talk2Tidb.create_posting_tbl(db, 'key2user_posting')
+            talk2Tidb.create_tbl_alike(db, 'key2user_posting')
 
-    for user in user_list:
-        open_id = user['open_id']
-        name = user['name']
-        en_name = user['en_name']
-        email = user['email']  # it depends on how many privileges you got through feishu
-        avatar = user['avatar']['avatar_72']
 
-        try:
-            leader = user['leader_user_id']
-        except KeyError:
-            leader = ''  # the top manager has no the key and contractor has no the key
+def _swap_tbl(db, tbl_alike, tbl):
+    """
+    Replace tbl with tbl_alike. Once tbl_alike is renamed, it is not done again when the swap is resumed
+    """
+    if talk2Tidb.tbl_exists(db, tbl_alike):
+        talk2Tidb.drop_tbl(db, tbl)
+        talk2Tidb.rn_tbl(db, tbl_alike, tbl)
 
-        url_id = okr_url_id.get_okr_url_id(email)
-        time.sleep(1)  # sleep 2 to give time
 
-        if not url_id or not url_id.isdigit():
-            my_utils.my_log('url_id is %s for user %s' % (url_id, name), level='DEBUG')
+@profiler.timed('server_refresh')
+def okrEx_refresh_cycle():
+    # Developement logcally
+    # OKR_EX_SERVER = 'http://127.0.0.1:3000/'
+    url = OKR_EX_SERVER + 'rebuild?rb=' + RB_CODE
 
-        okr_dict = get_data_from_feishu.get_latest_okr_by_open_id(open_id)
+    payload = ''
 
-        avail_obj, obj_nokr = my_utils.cal_avail_obj_by_okr_dict(okr_dict)
+    response = http_client.request("GET", url, data=payload, timeout=1200)
 
-        okr_str = json.dumps(okr_dict, ensure_ascii=False)  # in case of the Chinese mess
+    data = json.loads(response.text)
 
-        okr_content, nil, nil = my_utils.get_okrcontent_from_okr_str(okr_str)
+    return data
 
-        okr_str = okr_str.replace('\\', '\\\\')  # mysql will eat \, need change it to be \\
 
-        okr_str = okr_str.replace("'", "\\'")  # okr_str cannot have ', will affect sql insert, change it to be \'
+def _okr_hashcode(okr_dict):
+    """
+    The same hashcode as users.hashcode, see _build_user_row() and _segment_stage()
+    """
+    okr_content, nil, nil = my_utils.get_okrcontent_from_okr_str(json.dumps(okr_dict, ensure_ascii=False))
+    return hashlib.md5(okr_content.encode('utf-8')).hexdigest()
 
-        # seg_list = my_seg.my_seg(okr_content)
 
-        seg_dict = my_seg.my_seg(okr_content)
+def _changed_stage(pairs, stored, seen):
+    """
+    Args:
+        pairs: iterable of (user, okr_dict)
+        stored: dict, open_id => hashcode in the users table
+        seen: set, the open ids coming from Feishu are added into it
+    Return:
+        generator of (user, okr_dict), only the new users and the ones whose OKR hashcode changed
+    """
+    for user, okr_dict in pairs:
+        seen.add(user['open_id'])
+        if stored.get(user['open_id']) != _okr_hashcode(okr_dict):
+            yield user, okr_dict
 
-        segs = json.dumps(seg_dict, ensure_ascii=False)
 
-        hashcode = hashlib.md5(okr_content.encode('utf-8')).hexdigest()
+def refresh_users_incrementally():
+    """
+    Refresh the users table in place, without the shadow tables:
+    - the OKRs are fetched and hashed, only the new users and the ones whose OKR hashcode changed are
+      looked up, segmented and upserted, the users gone from Feishu are deleted
+    - key2user is patched with the changes of these users only
+    - top related is recalculated only for the neighbourhood, the users sharing a changed seg
+    The OKR is all that is compared, a change of name or leader alone waits for the next rebuild.
+    Return:
+        Int, how many users are changed
+    """
+    t1 = time.time()
+    db = talk2Tidb.connect_tidb_okr()
 
-        talk2Tidb.replace_user_entry(db=db,
-                                     tbl=users_alike,
-                                     open_id=open_id,
-                                     okr_str=okr_str,
-                                     name=name,
-                                     url_id=url_id,
-                                     email=email,
-                                     en_name=en_name,
-                                     leader=leader,
-                                     avatar=avatar,
-                                     avail_obj=avail_obj,
-                                     obj_nokr=obj_nokr,
-                                     segs=segs,
-                                     hashcode=hashcode,
-                                     hasupdate=0)
-    # Finished writing new table
+    cols = ('open_id', 'name', 'segs', 'hashcode')
+    tup_old = talk2Tidb.get_all_from_tbl_by_cols(db, 'users', cols)
+    stored = {t[0]: t[3] for t in tup_old}
+
+    seen = set()
+    cache = seg_cache.SegCache(version=my_seg.dict_fingerprint())
+    users = get_data_from_feishu.iter_all_user_dicts_from_feishu()
+    rows = list(_segment_stage(_url_id_stage(_changed_stage(_okr_stage(users), stored, seen)), cache))
+    cache.log_stats()
+    cache.save()
+
+    rows = [row for row in rows if row['open_id']]
+    users_id_changed = set(row['open_id'] for row in rows)
+    users_id_disappeared = set(stored) - seen
+    if len(users_id_disappeared) > len(stored) * REFRESH_MAX_GONE:
+        # more likely some departments failed to be fetched, let the next rebuild decide
+        my_utils.my_log('%s users disappeared, too many to delete in a refresh' % len(users_id_disappeared),
+                        level='WARNING')
+        users_id_disappeared = set()
+    t2 = time.time()
+    my_utils.my_log('%s users changed, %s disappeared in %s users, compared in %.3f seconds'
+                    % (len(users_id_changed), len(users_id_disappeared), len(seen), t2 - t1), level='DEBUG')
+
+    if not users_id_changed and not users_id_disappeared:
+        talk2Tidb.close_tidb_okr(db)
+        return 0
+
+    _write_stage(db, 'users', iter(rows), checkpoint.Checkpoint())
+    talk2Tidb.delete_users(db, 'users', users_id_disappeared)
+
+    # patch key2user with the same ops as the rebuild, on the changed users only
+    tup_new = [(row['open_id'], row['name'], row['segs'], row['hashcode']) for row in rows]
+    tup_old = [t for t in tup_old if t[0] in users_id_changed or t[0] in users_id_disappeared]
+    users_id_new = users_id_changed - set(stored)
+    ops = _key2user_ops(tup_old, tup_new, users_id_disappeared, users_id_new, users_id_changed - users_id_new)
+    plan = plan_key2user_ops(db, ops)
+    apply_key2user_plan(db, plan)
+
+    # only the users sharing a changed seg with a changed user can have a different top related
+    affected = set(users_id_changed)
+    for key in plan['howchanged']:
+        affected.update(plan['postings'].get(key, {}))
+    affected -= users_id_disappeared
+    cal_top_related(db, 'users', affected)
 
-    # start comparing the new users tbl and old one to decide which user is updated
-    if mode == 'hard':
-        update_key2user_tbl_with_users_change(db, users_alike, key2user_alike)
-    else:
-        update_key2user_tbl_with_users_change(db, users_alike)
-    cal_top_related(db, users_alike)
-    talk2Tidb.drop_tbl(db, 'users')
-    talk2Tidb.rn_tbl(db, users_alike, 'users')
-    if mode == 'hard':
-        talk2Tidb.drop_tbl(db, 'key2user')
-        talk2Tidb.rn_tbl(db, key2user_alike, 'key2user')
     update_okr_server_msg_tbl(db)
     talk2Tidb.close_tidb_okr(db)
 
+    my_utils.my_log('refreshed %s users and %s neighbours in place, used %.3f seconds'
+                    % (len(users_id_changed) + len(users_id_disappeared), len(affected), time.time() - t1),
+                    level='DEBUG')
+    return len(users_id_changed) + len(users_id_disappeared)
 
-def okrEx_refresh_cycle():
-    # Developement logcally
-    # OKR_EX_SERVER = 'http://127.0.0.1:3000/'
-    url = OKR_EX_SERVER + 'rebuild?rb=' + RB_CODE
 
-    payload = ''
+def refresh_base():
+    """
+    The incremental version of rebuild_base(), the departments wait for the next rebuild.
+    It is skipped while a broken rebuild is waiting to be resumed.
+    """
+    if os.path.exists(REBUILD_CHECKPOINT):
+        my_utils.my_log('skip the refresh, a rebuild is to be resumed', level='DEBUG')
+        return
+    profiler.profiler.begin()
+    try:
+        if refresh_users_incrementally():
+            okrEx_refresh_cycle()
+    finally:
+        _end_profile('refresh')
 
-    response = requests.request("GET", url, data=payload, timeout=1200)
 
-    data = json.loads(response.text)
-
-    return data
+def rebuild_base(mode='soft'):
+    """
+    Rebuild stage by stage. If a previous rebuild of the same mode broke halfway, it is resumed from
+    REBUILD_CHECKPOINT, the finished stages and users batches are not done again.
+    With --profile, the stats of the sub-stages are written into a JSON report, see profiler.py
+    """
+    profiler.profiler.begin()
+    try:
+        ckpt = checkpoint.Checkpoint.resume(REBUILD_CHECKPOINT, mode, REBUILD_CHECKPOINT_TTL * 3600)
+        t1 = time.time()
+        update_user_tbl_from_feishu(mode, ckpt)
+        t2 = time.time()
+        elasped = (t2 - t1)
+        my_utils.my_log('Finished users table and key2user update, used %.3f seconds' % elasped, level='DEBUG')
+        t1 = time.time()
+        if not ckpt.done('departments'):
+            build_departments_tbl()
+            ckpt.finish('departments')
+        t2 = time.time()
+        elasped = (t2 - t1)
+        my_utils.my_log('Finished departments table update, used %.3f seconds' % elasped, level='DEBUG')
+        # tell okrEx Server to update the local redis user table
+        t1 = time.time()
+        data = okrEx_refresh_cycle()
+        t2 = time.time()
+        elasped = (t2 - t1)
+        my_utils.my_log('Got feedback from okr server for internal update, used %.3f seconds' % elasped,
+                        level='DEBUG')
+        ckpt.clear()
+    finally:
+        _end_profile('rebuild_%s' % mode)
+
+
+def _end_profile(name):
+    """
+    Write the profile report, a failure here is logged and must not hide the one of the rebuild
+    """
+    try:
+        profiler.profiler.end(name)
+    except Exception as e:
+        my_utils.my_error(e)
 
 
-def rebuild_base(mode='soft'):
-    t1 = time.time()
-    update_user_tbl_from_feishu(mode)
-    t2 = time.time()
-    elasped = (t2 - t1)
-    my_utils.my_log('Finished users table and key2user update, used %.3f seconds' % elasped, level='DEBUG')
-    t1 = time.time()
-    build_departments_tbl()
-    t2 = time.time()
-    elasped = (t2 - t1)
-    my_utils.my_log('Finished departments table update, used %.3f seconds' % elasped, level='DEBUG')
-    # tell okrEx Server to update the local redis user table
-    t1 = time.time()
-    data = okrEx_refresh_cycle()
-    t2 = time.time()
-    elasped = (t2 - t1)
-    my_utils.my_log('Got feedback from okr server for internal update, used %.3f seconds' % elasped, level='DEBUG')
+def _try_rebuild_base():
+    """
+    Return:
+        Boolean, True if the rebuild is finished. A broken one keeps its checkpoint, the next try resumes it
+    """
+    try:
+        rebuild_base()
+        return True
+    except Exception as e:
+        my_utils.my_error(e)
+        return False
 
 
 def house_keep():
@@ -477,20 +871,29 @@ def house_keep():
     - Check if it is the date to rebuild the users tbl and key2user tbl
       Every begining day of each quarter
 
+    A broken rebuild is tried again a minute later, resuming from its checkpoint.
+    Between two rebuilds, the changed users are refreshed every REFRESH_INTERVAL minutes if it is set.
     """
     a = 0
     n = 0
-    rebuild_base()
-    n += 1
-    my_utils.my_log("Finished No %s times rebuild" % n, level='DEBUG')
-    rebuild_time = time.time()
+    rebuild_time = 0  # rebuild right away
+    refresh_time = 0
     while True:
         now_time = time.time()
         if now_time - rebuild_time > 3600 * interval:
-            rebuild_base()
-            n += 1
-            my_utils.my_log("Finished No %s times rebuild" % n, level='DEBUG')
-            rebuild_time = time.time()
+            if _try_rebuild_base():
+                n += 1
+                my_utils.my_log("Finished No %s times rebuild" % n, level='DEBUG')
+                rebuild_time = time.time()
+                refresh_time = rebuild_time
+            else:
+                time.sleep(60)
+        elif REFRESH_INTERVAL and now_time - refresh_time > 60 * REFRESH_INTERVAL:
+            try:
+                refresh_base()
+            except Exception as e:
+                my_utils.my_error(e)
+            refresh_time = time.time()
         else:
             time.sleep(10)
             a += 1
@@ -498,14 +901,30 @@ def house_keep():
 
 def main(argv):
     try:
-        opts, args = getopt.getopt(argv, "hri:", ["interval="])
+        opts, args = getopt.getopt(argv, "hrmui:", ["interval=", "profile", "cprofile"])
     except getopt.GetoptError:
-        print('opokr.py -r -i <interval>')
+        print('opokr.py -r -m -u -i <interval> --profile --cprofile')
         sys.exit(2)
 
+    # the profiling switches go first, they apply to the rebuild or refresh asked by the other options
+    for opt, arg in opts:
+        if opt in ("--profile", "--cprofile"):
+            profiler.profiler.enabled = True
+            profiler.profiler.cprofile = profiler.profiler.cprofile or opt == "--cprofile"
+
     for opt, arg in opts:
         if opt == '-h':
-            print('opokr.py -r -i <interval>')
+            print('opokr.py -r -m -u -i <interval> --profile --cprofile')
+            sys.exit()
+        elif opt == '-u':
+            print('refreshing the changed users')
+            refresh_base()
+            sys.exit()
+        elif opt == '-m':
+            print('migrating key2user to the posting table')
+            db = talk2Tidb.connect_tidb_okr()
+            talk2Tidb.migrate_key2user_to_posting(db)
+            talk2Tidb.close_tidb_okr(db)
             sys.exit()
         elif opt == '-r':
             print('rebuilding the bases in hard mode')
@@ -526,6 +945,7 @@ def main(argv):
 
 if __name__ == "__main__":
     my_utils.init_log('opokr.log', level='DEBUG')
+    my_seg.warm_up()
     main(sys.argv[1:])
 
 
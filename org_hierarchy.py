@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+# The file builds the leadership forest of the users: who leads whom, from the leader column of the users
+# table. It is built in one pass with an open_id => node dict, and the subordinates of every leader are
+# collected in one post-order traversal, so building it is linear in the headcount.
+#
+# Each node is also numbered when a depth first walk enters and exits it (an Euler tour), so
+# "is X under Y" is the interval check enter(Y) < enter(X) <= exit(Y), without walking the leader chain.
+
+
+class Node(object):
+    __slots__ = ('id', 'leader', 'subs', 'enter', 'exit')
+
+    def __init__(self, open_id, leader=None):
+        self.id = open_id
+        self.leader = leader
+        self.subs = []
+        self.enter = -1  # -1 until numbered, a node in a leader cycle is never numbered
+        self.exit = -1
+
+
+class Hierarchy(object):
+    """
+    Args:
+        leaders: iterable of (open_id, the open_id of the leader), the leader is empty for the top leaders.
+                 A leader out of the users is a top leader in the forest.
+    """
+
+    def __init__(self, leaders):
+        self.nodes = {}
+        self.roots = []
+        self.build(leaders)
+
+    def _node(self, open_id):
+        node = self.nodes.get(open_id)
+        if node is None:
+            node = self.nodes[open_id] = Node(open_id)
+        return node
+
+    def build(self, leaders):
+        order = []  # the nodes in the order they are met, for the order of the roots
+        for open_id, leader_id in leaders:
+            node = self._node(open_id)
+            if node.leader is None and not node.subs:
+                order.append(node)
+            node.leader = leader_id if leader_id and leader_id != open_id else ''
+            if node.leader:
+                leader = self._node(node.leader)
+                if leader.leader is None and not leader.subs:
+                    order.append(leader)
+                leader.subs.append(node)
+
+        for node in self.nodes.values():
+            if node.leader is None:  # a leader out of the users
+                node.leader = ''
+        self.roots = [node for node in order if not node.leader]
+        self._number()
+
+    def _number(self):
+        """
+        Number the nodes in a depth first walk, exit is the largest enter number in the subtree
+        """
+        counter = 0
+        for root in self.roots:
+            stack = [(root, False)]
+            while stack:
+                node, visited = stack.pop()
+                if visited:
+                    node.exit = counter - 1
+                    continue
+                node.enter = counter
+                counter += 1
+                stack.append((node, True))
+                for sub in reversed(node.subs):
+                    stack.append((sub, False))
+
+    def is_subordinate(self, leader_id, open_id):
+        """
+        Return:
+            Boolean, True if open_id is under leader_id at any level, a user is not his/her own subordinate
+        """
+        leader = self.nodes.get(leader_id)
+        node = self.nodes.get(open_id)
+        if leader is None or node is None or leader.enter < 0 or node.enter < 0:
+            return False
+        return leader.enter < node.enter <= leader.exit
+
+    def split_subordinates(self, leader_id, open_ids):
+        """
+        Args:
+            open_ids: iterable of open_id
+        Return:
+            (List of the ones under leader_id, List of the others), in the order of open_ids
+        """
+        leader = self.nodes.get(leader_id)
+        if leader is None or leader.enter < 0:
+            return [], list(open_ids)
+
+        subs = []
+        others = []
+        for open_id in open_ids:
+            node = self.nodes.get(open_id)
+            if node is not None and leader.enter < node.enter <= leader.exit:
+                subs.append(open_id)
+            else:
+                others.append(open_id)
+        return subs, others
+
+    def __contains__(self, open_id):
+        return open_id in self.nodes
+
+    def iter_post_order(self):
+        """
+        Return:
+            generator of the nodes, each after all its subordinates. The users in a leader cycle are not reachable
+        """
+        for root in self.roots:
+            stack = [(root, False)]
+            while stack:
+                node, visited = stack.pop()
+                if visited:
+                    yield node
+                    continue
+                stack.append((node, True))
+                for sub in reversed(node.subs):
+                    stack.append((sub, False))
+
+    def subordinates(self):
+        """
+        Return:
+            dict, open_id of a leader => (List of the direct subordinates, List of all the subordinates),
+            all the subordinates are the direct ones first, then the subordinates of each direct one in turn
+        """
+        result = {}
+        for node in self.iter_post_order():
+            if not node.subs:
+                continue
+            direct = [sub.id for sub in node.subs]
+            all_subs = list(direct)
+            for sub in node.subs:
+                if sub.id in result:
+                    all_subs.extend(result[sub.id][1])
+            result[node.id] = (direct, all_subs)
+        return result
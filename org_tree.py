@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import time
+
+from my_utils import my_log
+
+# The file keeps a snapshot of the department tree: parent => children and department => direct members.
+# It is fetched from Feishu once per rebuild (see get_data_from_feishu.get_org_tree) and saved on disk,
+# so the department questions are answered from memory by walking the subtree, without network calls.
+
+ROOT = "0"
+
+
+class OrgTree(object):
+    """
+    departments: dict, open_department_id => depart dict, see get_data_from_feishu.get_all_direct_child_departs()
+    children: dict, open_department_id => List of the direct child open_department_id, ROOT is the root
+    members: dict, open_department_id => List of the open id of the direct members
+    built: float, when the snapshot is fetched
+    """
+
+    def __init__(self, departments=None, children=None, members=None, built=None):
+        self.departments = departments if departments else {}
+        self.children = children if children else {ROOT: []}
+        self.members = members if members else {}
+        self.built = built if built else time.time()
+
+    def add_department(self, dep):
+        dep_id = dep['open_department_id']
+        if dep_id in self.departments:
+            return
+        self.departments[dep_id] = dep
+        self.children.setdefault(dep_id, [])
+        self.children.setdefault(dep.get('parent_department_id', ROOT), []).append(dep_id)
+
+    def set_members(self, dep_id, open_ids):
+        self.members[dep_id] = list(open_ids)
+
+    def direct_children(self, dep_id):
+        """
+        Return:
+            List of the depart dicts right under dep_id
+        """
+        return [self.departments[child] for child in self.children.get(dep_id, [])]
+
+    def descendants(self, dep_id):
+        """
+        Return:
+            List of the open_department_id of all the departments under dep_id at any level, parents first
+        """
+        result = []
+        stack = list(reversed(self.children.get(dep_id, [])))
+        while stack:
+            child = stack.pop()
+            result.append(child)
+            stack.extend(reversed(self.children.get(child, [])))
+        return result
+
+    def direct_members(self, dep_id):
+        return list(self.members.get(dep_id, []))
+
+    def users_in(self, dep_id):
+        """
+        Return:
+            set of the open id of all the users in dep_id and its sub departments
+        """
+        users = set(self.members.get(dep_id, []))
+        for child in self.descendants(dep_id):
+            users.update(self.members.get(child, []))
+        return users
+
+    def age(self):
+        return time.time() - self.built
+
+    def to_dict(self):
+        return {'built': self.built, 'departments': self.departments,
+                'children': self.children, 'members': self.members}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['departments'], data['children'], data['members'], data['built'])
+
+    def save(self, path):
+        """
+        Write the snapshot into path atomically, a reader never sees a half written file
+        """
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False)
+        os.replace(tmp, path)
+        my_log('org tree of %s departments is saved into %s' % (len(self.departments), path), level='DEBUG')
+
+    @classmethod
+    def load(cls, path):
+        """
+        Return:
+            the OrgTree saved in path, None if there is not or it is broken
+        """
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            with open(path, encoding='utf-8') as f:
+                return cls.from_dict(json.load(f))
+        except (ValueError, KeyError) as e:
+            my_log('ignore the broken org tree %s: %s' % (path, e), level='WARNING')
+            return None
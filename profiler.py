@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import cProfile
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from my_utils import my_log
+from dotenv import load_dotenv, find_dotenv
+
+# The file profiles a rebuild stage by stage, turned on by `python3 opokr.py --profile`.
+#
+# The code marks its sub-stages with profiler.stage(name) or @profiler.timed(name). Each stage keeps
+# its call count, wall time and CPU time (of the thread running it), both inclusive of the nested
+# stages, and the bytes transferred and rows written, which are added to the innermost stage of the
+# thread. The segmentation runs in the process pool, so its CPU time is not in the report, only its wall.
+# At the end of the rebuild the stats are written as a JSON report, with a cProfile dump of the main
+# thread if asked. When the profiler is off, a stage costs one flag check.
+
+# get environmental parameter from .env files
+load_dotenv(find_dotenv())
+
+PROFILE_DIR = os.getenv("PROFILE_DIR") if os.getenv("PROFILE_DIR") else 'profiles'
+
+
+class StageStats(object):
+    __slots__ = ('calls', 'wall', 'cpu', 'bytes', 'rows')
+
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.bytes = 0
+        self.rows = 0
+
+    def to_dict(self):
+        return {'calls': self.calls, 'wall': round(self.wall, 6), 'cpu': round(self.cpu, 6),
+                'bytes': self.bytes, 'rows': self.rows}
+
+
+class Profiler(object):
+    """
+    Args:
+        enabled: Boolean, nothing is recorded when it is False
+        cprofile: Boolean, also run cProfile on the thread calling begin()
+        directory: String, where the reports are written
+    """
+
+    def __init__(self, enabled=False, cprofile=False, directory=PROFILE_DIR):
+        self.enabled = enabled
+        self.cprofile = cprofile
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stats = {}
+        self.started = 0.0
+        self.started_cpu = 0.0
+        self.cprof = None
+
+    def _stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def _record(self, name, wall=0.0, cpu=0.0, calls=0, transferred=0, rows=0):
+        with self.lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = StageStats()
+            stats.calls += calls
+            stats.wall += wall
+            stats.cpu += cpu
+            stats.bytes += transferred
+            stats.rows += rows
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        stack = self._stack()
+        stack.append(name)
+        t0 = time.perf_counter()
+        c0 = time.thread_time()
+        try:
+            yield
+        finally:
+            stack.pop()
+            self._record(name, wall=time.perf_counter() - t0, cpu=time.thread_time() - c0, calls=1)
+
+    def timed(self, name):
+        """
+        Decorator, every call of the function is the stage <name>
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def add(self, transferred=0, rows=0):
+        """
+        Count bytes transferred and rows written into the innermost stage of the calling thread
+        """
+        if not self.enabled:
+            return
+        stack = self._stack()
+        self._record(stack[-1] if stack else 'other', transferred=transferred, rows=rows)
+
+    def begin(self):
+        """
+        Clear the stats, called at the start of a rebuild
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.stats = {}
+        self.started = time.perf_counter()
+        self.started_cpu = time.process_time()
+        if self.cprofile:
+            self.cprof = cProfile.Profile()
+            self.cprof.enable()
+
+    def end(self, name):
+        """
+        Write the report of the stats since begin() into <directory>/<name>_<time>.json, and the
+        cProfile dump into the .prof file of the same name.
+        Return:
+            String, the report path, '' if the profiler is off
+        """
+        if not self.enabled:
+            return ''
+
+        # stop the cProfile first, it must not keep running when the report can not be written
+        cprof, self.cprof = self.cprof, None
+        if cprof is not None:
+            cprof.disable()
+
+        prefix = os.path.join(self.directory, '%s_%s' % (name, time.strftime('%Y%m%d-%H%M%S')))
+        os.makedirs(self.directory, exist_ok=True)
+
+        report = {'name': name,
+                  'finished': time.strftime('%Y-%m-%d %H:%M:%S'),
+                  'wall': round(time.perf_counter() - self.started, 6),
+                  'cpu': round(time.process_time() - self.started_cpu, 6),
+                  'stages': {}}
+        with self.lock:
+            for stage, stats in sorted(self.stats.items()):
+                report['stages'][stage] = stats.to_dict()
+
+        if cprof is not None:
+            cprof.dump_stats(prefix + '.prof')
+            report['cprofile'] = prefix + '.prof'
+
+        with open(prefix + '.json', 'w') as f:
+            json.dump(report, f, indent=2)
+        my_log('profile report is written into %s.json' % prefix, level='DEBUG')
+        return prefix + '.json'
+
+
+profiler = Profiler()
+
+
+def stage(name):
+    return profiler.stage(name)
+
+
+def timed(name):
+    return profiler.timed(name)
+
+
+def add(transferred=0, rows=0):
+    profiler.add(transferred, rows)
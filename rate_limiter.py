@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import re
+import threading
+import time
+import http_client
+from my_utils import my_log
+from dotenv import load_dotenv, find_dotenv
+
+# The file schedules all the calls to the Feishu open APIs.
+# Each endpoint has a token bucket with its own quota. When Feishu answers with HTTP 429 or a
+# rate limit error code, the endpoint backs off (honouring retry-after when Feishu gives one) and
+# its rate is lowered, then it slowly recovers to the quota with the following successful calls.
+#
+# The clock, the sleep function and the HTTP session are all replaceable, so the throttling can be
+# checked offline, see tests/test_rate_limiter.py.
+
+# get environmental parameter from .env files
+load_dotenv(find_dotenv())
+
+# requests per second, like 'contact=50,okr=10'. The endpoints not listed use FEISHU_DEFAULT_QPS
+FEISHU_QUOTAS = os.getenv("FEISHU_QUOTAS") if os.getenv("FEISHU_QUOTAS") else ''
+FEISHU_DEFAULT_QPS = float(os.getenv("FEISHU_DEFAULT_QPS") if os.getenv("FEISHU_DEFAULT_QPS") else '20')
+FEISHU_MAX_RETRY = int(os.getenv("FEISHU_MAX_RETRY") if os.getenv("FEISHU_MAX_RETRY") else '5')
+
+# Feishu error code meaning the frequency limit is triggered
+RATE_LIMIT_CODES = (99991400,)
+
+# the tokens drift by float errors, a bucket this close to one token has one
+TOKEN_EPSILON = 1e-9
+# the shortest wait, so a waiter always moves the clock forward
+MIN_WAIT = 1e-6
+
+# endpoint name and the path pattern, the first match wins
+ENDPOINTS = [
+    ('auth', re.compile(r'/open-apis/auth/')),
+    ('authen', re.compile(r'/open-apis/authen/')),
+    ('jssdk', re.compile(r'/open-apis/jssdk/')),
+    ('department', re.compile(r'/open-apis/contact/v3/departments')),
+    ('contact', re.compile(r'/open-apis/contact/')),
+    ('okr', re.compile(r'/open-apis/okr/')),
+    ('im', re.compile(r'/open-apis/im/')),
+]
+
+DEFAULT_QUOTAS = {
+    'auth': 5,
+    'department': 50,
+    'contact': 50,
+    'okr': 10,
+    'im': 50,
+    'url_id': 4,  # the OKR url id server, see okr_url_id.py
+}
+
+
+def parse_quotas(quotas_str):
+    """
+    Args:
+        quotas_str: String, like 'contact=50,okr=10'
+    Return:
+        dict, endpoint name => requests per second
+    """
+    quotas = {}
+    for item in quotas_str.split(','):
+        if '=' not in item:
+            continue
+        name, qps = item.split('=', 1)
+        try:
+            quotas[name.strip()] = float(qps)
+        except ValueError:
+            my_log('ignore the bad quota %s' % item, level='WARNING')
+    return quotas
+
+
+def endpoint_of(url):
+    """
+    Return the endpoint name the url belongs to, 'default' if none matches
+    """
+    for name, pattern in ENDPOINTS:
+        if pattern.search(url):
+            return name
+    return 'default'
+
+
+class TokenBucket(object):
+    """
+    Refills <rate> tokens per second up to <capacity>, one token per request.
+    The rate drops when the server says we are too fast and climbs back to the quota afterwards.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        self.quota = float(rate)
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity else max(1.0, float(rate))
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated = clock()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def reserve(self):
+        """
+        Take one token if there is.
+        Return:
+            float, 0 if the request can go now, otherwise the seconds to wait before trying again
+        """
+        with self.lock:
+            now = self.clock()
+            if now < self.blocked_until:
+                return max(MIN_WAIT, self.blocked_until - now)
+            self._refill(now)
+            if self.tokens >= 1 - TOKEN_EPSILON:
+                self.tokens = max(0.0, self.tokens - 1)
+                return 0.0
+            return max(MIN_WAIT, (1 - self.tokens) / self.rate)
+
+    def block(self, seconds):
+        """
+        Stop all the requests for <seconds> and halve the rate
+        """
+        with self.lock:
+            now = self.clock()
+            self.blocked_until = max(self.blocked_until, now + seconds)
+            self.tokens = 0.0
+            self.updated = max(now, self.updated)
+            self.rate = max(self.quota / 16, self.rate / 2)
+
+    def relax(self):
+        """
+        Called after a successful request, win back a little of the rate
+        """
+        with self.lock:
+            if self.rate < self.quota:
+                self.rate = min(self.quota, self.rate + self.quota / 10)
+
+
+class Scheduler(object):
+    """
+    One token bucket per endpoint, all the Feishu calls should go through call()
+    """
+
+    def __init__(self, quotas=None, default_qps=FEISHU_DEFAULT_QPS, max_retry=FEISHU_MAX_RETRY,
+                 base_backoff=1.0, max_backoff=60.0, clock=time.monotonic, sleep=time.sleep):
+        self.quotas = dict(DEFAULT_QUOTAS)
+        if quotas:
+            self.quotas.update(quotas)
+        self.default_qps = default_qps
+        self.max_retry = max_retry
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.sleep = sleep
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.throttled = 0  # how many responses told us to slow down
+
+    def bucket(self, endpoint):
+        with self.lock:
+            if endpoint not in self.buckets:
+                self.buckets[endpoint] = TokenBucket(self.quotas.get(endpoint, self.default_qps),
+                                                     clock=self.clock)
+            return self.buckets[endpoint]
+
+    def acquire(self, endpoint):
+        """
+        Block until the endpoint allows one more request
+        """
+        bucket = self.bucket(endpoint)
+        wait = bucket.reserve()
+        while wait > 0:
+            self.sleep(wait)
+            wait = bucket.reserve()
+
+    def backoff(self, attempt, retry_after=None):
+        """
+        Return the seconds to back off, retry_after from the server wins when there is
+        """
+        if retry_after is not None:
+            return retry_after
+        return min(self.max_backoff, self.base_backoff * (2 ** attempt))
+
+    def call(self, endpoint, send):
+        """
+        Args:
+            endpoint: String, the endpoint name, see endpoint_of()
+            send: function without argument, sends the request and returns the response
+        Return:
+            the response. If it is still rate limited after max_retry times, the last response
+        """
+        attempt = 0
+        while True:
+            self.acquire(endpoint)
+            response = send()
+            limited, retry_after = is_rate_limited(response)
+            if not limited:
+                self.bucket(endpoint).relax()
+                return response
+
+            self.throttled += 1
+            seconds = self.backoff(attempt, retry_after)
+            my_log('%s is rate limited, back off %.1f seconds' % (endpoint, seconds), level='WARNING')
+            self.bucket(endpoint).block(seconds)
+
+            attempt += 1
+            if attempt > self.max_retry:
+                return response
+
+
+def _retry_after(response):
+    """
+    Return the seconds the server asks us to wait, None if it does not say
+    """
+    for header in ('Retry-After', 'x-ogw-ratelimit-reset'):
+        value = response.headers.get(header)
+        if value:
+            try:
+                return max(0.0, float(value))
+            except ValueError:
+                continue
+    return None
+
+
+def is_rate_limited(response):
+    """
+    Return:
+        (Boolean, retry after seconds or None)
+    """
+    if response.status_code == 429:
+        return True, _retry_after(response)
+
+    try:
+        code = json.loads(response.content).get('code')
+    except Exception:  # not a json dict, can not be a Feishu error code
+        return False, None
+
+    if code in RATE_LIMIT_CODES:
+        return True, _retry_after(response)
+    return False, None
+
+
+scheduler = Scheduler(quotas=parse_quotas(FEISHU_QUOTAS))
+
+
+def request(method, url, **kwargs):
+    """
+    Same as http_client.request, but scheduled by the endpoint quota
+    """
+    return scheduler.call(endpoint_of(url), lambda: http_client.request(method, url, **kwargs))
+
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+from collections import OrderedDict
+from dotenv import load_dotenv, find_dotenv
+
+from my_utils import my_error, my_log
+
+# The file keeps the segmentation result of the OKRs between rebuilds.
+# The key is the md5 hashcode of the OKR content, the same one saved in users.hashcode,
+# so an unchanged OKR reuses its segs instead of being segmented again.
+# The cache is dropped when the segmentation itself changes, e.g. a new user dictionary or stop words.
+
+# get environmental parameter from .env files
+load_dotenv(find_dotenv())
+
+SEG_CACHE_FILE = os.getenv("SEG_CACHE_FILE") if os.getenv("SEG_CACHE_FILE") else 'seg_cache.json'
+SEG_CACHE_SIZE = int(os.getenv("SEG_CACHE_SIZE") if os.getenv("SEG_CACHE_SIZE") else '20000')
+
+
+class SegCache(object):
+    """
+    hashcode => segs, the JSON string of the seg dict.
+    At most max_size entries, the least recently used one is evicted first.
+    version tells which segmentation the entries come from, see my_seg.dict_fingerprint()
+    """
+
+    def __init__(self, path=SEG_CACHE_FILE, max_size=SEG_CACHE_SIZE, version=''):
+        self.path = path
+        self.max_size = max_size
+        self.version = version
+        self.entries = OrderedDict()  # the least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data['version'] != self.version:
+                my_log('segmentation changed, the seg cache is dropped', level='DEBUG')
+                return
+            for hashcode, segs in data['entries']:  # saved as a list in the LRU order
+                self.entries[hashcode] = segs
+        except Exception as e:  # a broken cache is just an empty one
+            my_error(e)
+            self.entries.clear()
+
+    def save(self):
+        """
+        Write the cache file atomically, a crash never leaves a half written file
+        """
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': self.version, 'entries': list(self.entries.items())}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            my_error(e)
+
+    def get(self, hashcode):
+        """
+        Return the segs of the hashcode, None if it is not cached
+        """
+        segs = self.entries.get(hashcode)
+        if segs is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(hashcode)
+        self.hits += 1
+        return segs
+
+    def put(self, hashcode, segs):
+        self.entries[hashcode] = segs
+        self.entries.move_to_end(hashcode)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        return 'seg cache: %s hits, %s misses, %s evictions, %s entries' \
+               % (self.hits, self.misses, self.evictions, len(self.entries))
+
+    def log_stats(self):
+        my_log(self.stats(), level='DEBUG')
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import heapq
+import json
+import numpy as np
+from scipy import sparse
+
+# The file scores how related two users' OKRs are, see opokr.segs_relevancy() for the formula:
+#   relevancy(base, comp) = len(shared segs) * 0.7 + (comp's count of shared segs) / (base's count of all segs)
+#
+# Users are rows of a sparse user x seg matrix. Multiplying the matrix with its transpose walks the
+# seg => user inverted index, so only the users sharing at least one seg with each other are scored,
+# instead of all the N*N pairs.
+
+BLOCK_SIZE = 256  # how many users are scored against all the others at a time
+
+
+def build_user_seg_matrix(segs_list):
+    """
+    Args:
+        segs_list: List of String, the users.segs column, a JSON dict {'seg': count} per user
+    Return:
+        (counts, presence, base_freq)
+        counts: csr matrix, users x segs, how many times the user mentions the seg
+        presence: csr matrix, users x segs, 1 if the user mentions the seg
+        base_freq: ndarray, the count of all segs per user
+    """
+    vocab = {}
+    indptr = [0]
+    indices = []
+    data = []
+
+    for segs in segs_list:
+        if segs and segs != '{}':
+            for seg, num in json.loads(segs).items():
+                indices.append(vocab.setdefault(seg, len(vocab)))
+                data.append(num)
+        indptr.append(len(indices))
+
+    shape = (len(segs_list), len(vocab))
+    counts = sparse.csr_matrix((np.array(data, dtype=np.float64),
+                                np.array(indices, dtype=np.int64),
+                                np.array(indptr, dtype=np.int64)), shape=shape)
+    presence = sparse.csr_matrix((np.ones(len(data), dtype=np.float64),
+                                  np.array(indices, dtype=np.int64),
+                                  np.array(indptr, dtype=np.int64)), shape=shape)
+    base_freq = np.asarray(counts.sum(axis=1)).ravel()
+
+    return counts, presence, base_freq
+
+
+def iter_relevancy_rows(segs_list, block_size=BLOCK_SIZE, rows=None):
+    """
+    Args:
+        segs_list: see build_user_seg_matrix()
+        rows: List of Int, only score these users against all the others, None means all the users
+    Return:
+        generator of (index, cols, rels), one per user in the order of segs_list (or rows).
+        cols: ndarray, ascending indexes of the users sharing at least one seg with the user, itself included
+        rels: ndarray, relevancy(user index as base, user cols as comp), all > 0
+    """
+    counts, presence, base_freq = build_user_seg_matrix(segs_list)
+    presence_t = presence.T.tocsc()
+    counts_t = counts.T.tocsc()
+
+    if rows is None:
+        rows = range(len(segs_list))
+    rows = list(rows)
+
+    for start in range(0, len(rows), block_size):
+        indexes = rows[start:start + block_size]
+        block = presence[indexes]
+
+        # both products have the same non-zero pattern: the user pairs sharing segs
+        inter = (block @ presence_t).tocsr()
+        comp = (block @ counts_t).tocsr()
+        inter.sort_indices()
+        comp.sort_indices()
+
+        for row, index in enumerate(indexes):
+            lo, hi = inter.indptr[row], inter.indptr[row + 1]
+            cols = inter.indices[lo:hi]
+            if hi == lo:
+                yield index, cols, np.zeros(0)
+                continue
+            rels = inter.data[lo:hi] * 0.7 + comp.data[lo:hi] / base_freq[index]
+            yield index, cols, rels
+
+
+class TopK(object):
+    """
+    Keeps the k best items by score, O(log k) per push.
+    A higher score wins, for the same score the smaller index wins, so the result does not depend on the push order.
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self.heap = []  # min heap of (score, -index), the root is the worst one kept
+
+    def push(self, score, index):
+        entry = (score, -index)
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, entry)
+        elif entry > self.heap[0]:
+            heapq.heapreplace(self.heap, entry)
+
+    def items(self):
+        """
+        Return:
+            List of (index, score), the best first
+        """
+        return [(-neg_index, score) for score, neg_index in sorted(self.heap, reverse=True)]
+
+
+def iter_top_related(segs_list, k, block_size=BLOCK_SIZE, rows=None):
+    """
+    Args:
+        segs_list: see build_user_seg_matrix()
+        k: Int, at most how many related users are kept per user
+        rows: see iter_relevancy_rows()
+    Return:
+        generator of (index, top), one per user in the order of segs_list (or rows).
+        top: List of (other index, relevancy), the k most related other users, the best first.
+        Every other user is considered, no matter it is before or after the user in segs_list.
+    """
+    for index, cols, rels in iter_relevancy_rows(segs_list, block_size, rows):
+        top = TopK(k)
+        for col, rel in zip(cols.tolist(), rels.tolist()):
+            if col != index:
+                top.push(rel, col)
+        yield index, top.items()
@@ -5,6 +5,7 @@ import pymysql
 from dotenv import load_dotenv, find_dotenv
 import os
 
+import profiler
 from my_utils import my_error, my_log
 
 # get environmental parameter from .env files
@@ -15,6 +16,15 @@ DB_USER = os.getenv("DB_USER")
 DB_PASSWD = os.getenv("DB_PASSWD")
 DATABASE = os.getenv("DATABASE")
 DB_PORT = os.getenv("DB_PORT")
+# a bulk writer flushes when it has buffered so many rows or so many bytes of values
+DB_BULK_ROWS = int(os.getenv("DB_BULK_ROWS") if os.getenv("DB_BULK_ROWS") else '500')
+DB_BULK_BYTES = int(os.getenv("DB_BULK_BYTES") if os.getenv("DB_BULK_BYTES") else str(1024 * 1024))
+# 'json' keeps each seg's mentioners as a JSON dict in key2user.open_id_list
+# 'posting' keeps them in key2user_posting, one row per (seg, open_id, num), see migrate_key2user_to_posting()
+# The OkrEx Server reads it from here too, so the server and the rebuild always agree
+KEY2USER_STORAGE = os.getenv("KEY2USER_STORAGE") if os.getenv("KEY2USER_STORAGE") else 'json'
+if KEY2USER_STORAGE not in ('json', 'posting'):
+    raise ValueError('KEY2USER_STORAGE must be json or posting, not %s' % KEY2USER_STORAGE)
 
 
 # connect to my tidb
@@ -37,13 +47,11 @@ def close_tidb_okr(db):
         db.close()
 
 
-def replace_user_entry(db, tbl, open_id, okr_str, name, url_id, email, en_name, leader, avatar, avail_obj, obj_nokr,
-                       segs, hashcode,
-                       hasupdate):
+def user_entry_values(open_id, okr_str, name, url_id, email, en_name, leader, avatar, avail_obj, obj_nokr,
+                      segs, hashcode,
+                      hasupdate):
     """
     Args:
-        db: the pymysql db object
-        tbl: table name, string
         open_id: String, the primary key of the table users
         okr_str: String, the okr str transferred from okr dict
         name: String, an user's primary name, not null
@@ -54,162 +62,246 @@ def replace_user_entry(db, tbl, open_id, okr_str, name, url_id, email, en_name,
         avatar: String, URL to the avatar of the user
         avail_obj:
         obj_nokr:
-        top_related:String, top 10 people most similar with the user ,; as delimiter
         segs: String of dict {'key1':1,'key2':2}
         hashcode: 32 bytes String, md5 value of he okr_str
         hasupdate: int 0 or 1
     Return:
-        Null
+        String, the values part "(...)" of one users table entry, top_related is left empty
+    """
+    return "('%s','%s','%s','%s','%s','%s','%s','%s',%s,%s,'%s','%s','%s',%s)" % (open_id,
+                                                                                 okr_str,
+                                                                                 name,
+                                                                                 url_id,
+                                                                                 email,
+                                                                                 en_name,
+                                                                                 leader,
+                                                                                 avatar,
+                                                                                 avail_obj,
+                                                                                 obj_nokr,
+                                                                                 '',
+                                                                                 segs,
+                                                                                 hashcode,
+                                                                                 hasupdate)
+
+
+class BulkWriter(object):
+    """
+    Buffers the rows of one table and writes them as multi-row statements,
+    each flush is one statement in one transaction.
+
+    Usage:
+        with BulkWriter(db, 'users_like9527') as writer:
+            for ...:
+                writer.add(user_entry_values(...))
 
-    The function will update the user table, can be called repeatedly.
+    Args:
+        db: the pymysql db object
+        tbl: table name, string
+        cols: String, like 'seg,freq', empty means all the columns in the table order
+        verb: String, 'replace' or 'insert'
+        on_duplicate: String, appended to insert statements, like 'on duplicate key update freq=values(freq)'
+        max_rows: Int, flush when so many rows are buffered
+        max_bytes: Int, flush before the values buffered would exceed so many bytes
     """
 
-    if not db or not open_id:
-        return
+    def __init__(self, db, tbl, cols='', verb='replace', on_duplicate='',
+                 max_rows=DB_BULK_ROWS, max_bytes=DB_BULK_BYTES):
+        self.db = db
+        self.head = '%s into %s%s values' % (verb, tbl, ' (%s)' % cols if cols else '')
+        self.tail = ' ' + on_duplicate if on_duplicate else ''
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.rows = []
+        self.size = 0
+        self.written = 0  # rows written successfully
+        self.flushes = 0
+
+    def add(self, values):
+        """
+        Args:
+            values: String, one row like "('a','b',1)"
+        """
+        size = len(values.encode('utf-8'))
+        if self.rows and self.size + size > self.max_bytes:
+            self.flush()
+        self.rows.append(values)
+        self.size += size
+        if len(self.rows) >= self.max_rows:
+            self.flush()
+
+    @profiler.timed('db_write')
+    def _execute(self, rows):
+        cursor = self.db.cursor()
+        try:
+            self.db.begin()
+            sql = self.head + ','.join(rows) + self.tail
+            cursor.execute(sql)
+            self.db.commit()
+            profiler.add(transferred=len(sql.encode('utf-8')), rows=len(rows))
+            ok = True
+        except Exception as e:
+            my_error(e)
+            self.db.rollback()
+            ok = False
+        cursor.close()
+        return ok
+
+    def flush(self):
+        if not self.rows:
+            return
+
+        rows = self.rows
+        self.rows = []
+        self.size = 0
+        self.flushes += 1
+
+        if self._execute(rows):
+            self.written += len(rows)
+        elif len(rows) > 1:
+            # one bad row fails the whole statement, write them one by one to lose only the bad ones
+            for row in rows:
+                if self._execute([row]):
+                    self.written += 1
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def get_key2user_by_keys(db, tbl, keys):
+    """
+    Args:
+        keys: iterable of the segs
+    Return:
+        dict, seg => {open_id: num}, for the keys existing in the tbl
+    """
+    postings = {}
+    keys = list(keys)
+    for i in range(0, len(keys), 500):
+        in_str = ','.join(["'%s'" % k.replace('\\', '\\\\') for k in keys[i:i + 500]])
+        sql = "select seg,open_id_list from %s where seg in (%s)" % (tbl, in_str)
+        for seg, open_id_list in query_tidb_okr(db, sql):
+            postings[seg] = json.loads(open_id_list) if open_id_list else {}
+    return postings
 
-    cursor = db.cursor()
 
-    sql = "replace into %s values('%s','%s','%s','%s','%s','%s','%s','%s',%s,%s,'%s','%s','%s',%s)" % (tbl,
-                                                                                                       open_id,
-                                                                                                       okr_str,
-                                                                                                       name,
-                                                                                                       url_id,
-                                                                                                       email,
-                                                                                                       en_name,
-                                                                                                       leader,
-                                                                                                       avatar,
-                                                                                                       avail_obj,
-                                                                                                       obj_nokr,
-                                                                                                       '',
-                                                                                                       segs,
-                                                                                                       hashcode,
-                                                                                                       hasupdate)
+def upsert_key2user(db, tbl, postings, howchanged, with_list=True):
+    """
+    Args:
+        postings: dict, seg => {open_id: num}
+        howchanged: dict, seg => 'add', 'update' or 'delete', only these segs are written
+        with_list: Boolean, False to leave open_id_list empty when the postings are kept in key2user_posting
+    Write the changed segs in multi-row upserts
+    """
+    writer = BulkWriter(db, tbl, cols='seg,open_id_list,freq,howchanged', verb='insert',
+                        on_duplicate='on duplicate key update open_id_list=values(open_id_list),'
+                                     'freq=values(freq),howchanged=values(howchanged)')
+    for key, how in howchanged.items():
+        if how == 'delete':
+            open_id_list, freq = '', 0
+        else:
+            open_id_list = json.dumps(postings[key]) if with_list else ''
+            freq = len(postings[key])
+        writer.add("('%s','%s',%s,'%s')" % (key.replace('\\', '\\\\'), open_id_list, freq, how))
+    writer.close()
+    my_log('upserted %s keys into %s in %s statements' % (writer.written, tbl, writer.flushes), level='DEBUG')
 
-    try:
-        cursor.execute(sql)
-        db.commit()
-    except Exception as e:
-        my_error(e)
-        # many insert duplicate keys failure is proper here
-        db.rollback()
 
-    cursor.close()
-    return
+def posting_tbl_of(tbl):
+    """
+    Return the posting table name going with the key2user table, e.g. key2user_like9527 => key2user_posting_like9527
+    """
+    return tbl.replace('key2user', 'key2user_posting', 1)
 
 
-def build_key2user_by_key(db, tbl, key, open_id, num):
-    sql = "select seg,open_id_list from %s where seg='%s'" % (tbl, key)
-    data = query_tidb_okr(db, sql)
+def create_posting_tbl(db, tbl):
+    """
+    mysql> desc key2user_posting;
+    +---------+--------------+------+------+---------+-------+
+    | Field   | Type         | Null | Key  | Default | Extra |
+    +---------+--------------+------+------+---------+-------+
+    | seg     | varchar(128) | NO   | PRI  | NULL    |       |
+    | open_id | varchar(64)  | NO   | PRI  | NULL    |       |
+    | num     | int(11)      | YES  |      | NULL    |       |
+    +---------+--------------+------+------+---------+-------+
+    The primary key (seg, open_id) keeps the postings of one seg together for range scans.
+    """
+    sql = 'create table if not exists %s (seg varchar(128) not null, open_id varchar(64) not null, ' \
+          'num int(11), primary key (seg, open_id))' % tbl
+    query_tidb_okr(db, sql)
 
-    if not data:  # if empty tuple
-        open_id_dict = {open_id: num}
-        open_id = json.dumps(open_id_dict)
-        sql = "insert into %s(seg,open_id_list,freq,howchanged) values('%s','%s',1,'%s')" \
-              % (tbl, key, open_id, 'add')
-        query_tidb_okr(db, sql)
-    else:
-        open_id_str = data[0][1]  # data is tuple, each element is a line, also a tuple
-        open_id_dict = json.loads(open_id_str)
-        my_log("Checking if %s is in the seg %s user list before adding " % (open_id, key), level='DEBUG')
-        if open_id in open_id_dict.keys():
-            open_id_dict[open_id] += num
-        else:
-            open_id_dict[open_id] = num
-        # if old_open_id_str.find(open_id) < 0:  # only if the open_id is not in the open_id_str
-        # new_open_id_str = old_open_id_str + ';' + open_id
-        freq = len(open_id_dict.keys())
-        sql = "update %s set open_id_list='%s',freq=%s,howchanged='update' where seg='%s'" \
-              % (tbl, json.dumps(open_id_dict), freq, key)
-        query_tidb_okr(db, sql)
+
+def get_postings_by_keys(db, tbl, keys):
+    """
+    Same as get_key2user_by_keys(), but reads the posting table tbl
+    """
+    postings = {}
+    keys = list(keys)
+    for i in range(0, len(keys), 500):
+        in_str = ','.join(["'%s'" % k.replace('\\', '\\\\') for k in keys[i:i + 500]])
+        sql = "select seg,open_id,num from %s where seg in (%s)" % (tbl, in_str)
+        for seg, open_id, num in query_tidb_okr(db, sql):
+            postings.setdefault(seg, {})[open_id] = num
+    return postings
 
 
-def update_tidb_key2user_by_key(db, key, open_id, num, add, obj):
+def update_postings(db, tbl, old_postings, new_postings, keys):
     """
-    Argus:
-        db: the pymysql connection obj
-        key: String, the seg
-        open_id: String, one user's open_id
-        num: how many times the key appears in the open_id's OKR
-        add: Boolean. If True, the func will add the open_id into the key;otherwise will remove the open_id from the key
-        obj: backup
-    Return:
-        Null
-    The function will update the key2users tbl for the entry with key.
-    mysql> desc key2user_schema;
-    +---------------------+--------------+------+------+---------+-------+
-    | Field               | Type         | Null | Key  | Default | Extra |
-    +---------------------+--------------+------+------+---------+-------+
-    | seg                 | varchar(128) | NO   | PRI  | NULL    |       |
-    | open_id_list        | text         | YES  |      | NULL    |       |
-    | freq                | int(11)      | YES  |      | NULL    |       |
-    | open_id_list_notify | text         | YES  |      | NULL    |       |
-    +---------------------+--------------+------+------+---------+-------+
-    4 rows in set (0.11 sec)
-    """
-
-    if not db or not key:
-        return
+    Args:
+        tbl: the posting table
+        old_postings: dict, seg => {open_id: num}, what tbl has now
+        new_postings: dict, seg => {open_id: num}, what tbl should have
+        keys: the segs to compare
+    Only the (seg, open_id) pairs whose num changed are written, the disappeared ones are deleted
+    """
+    writer = BulkWriter(db, tbl, cols='seg,open_id,num', verb='insert',
+                        on_duplicate='on duplicate key update num=values(num)')
+    removed = []
+    for key in keys:
+        old = old_postings.get(key, {})
+        new = new_postings.get(key, {})
+        _key = key.replace('\\', '\\\\')
+        for open_id, num in new.items():
+            if old.get(open_id) != num:
+                writer.add("('%s','%s',%s)" % (_key, open_id, num))
+        for open_id in old:
+            if open_id not in new:
+                removed.append("('%s','%s')" % (_key, open_id))
+    writer.close()
+
+    for i in range(0, len(removed), 500):
+        sql = "delete from %s where (seg,open_id) in (%s)" % (tbl, ','.join(removed[i:i + 500]))
+        query_tidb_okr(db, sql)
 
-    key = key.lower()  # all stored keys to be lowercase
-    key = key.replace("'", "")
+    my_log('upserted %s and deleted %s postings in %s' % (writer.written, len(removed), tbl), level='DEBUG')
 
-    cursor = db.cursor()
-    sql = "select seg,open_id_list from key2user where seg='%s'" % key
-    data = query_tidb_okr(db, sql)
 
-    if not data:  # if empty tuple
-        open_id_dict = {open_id: num}
-        open_id_list_str = json.dumps(open_id_dict)
-        if add:  # trying to add the open_id to the key
-            sql = "insert into key2user(seg,open_id_list,freq,howchanged) values('%s','%s',1,'%s')" \
-                  % (key, open_id_list_str, 'add')
-            data = query_tidb_okr(db, sql)
-        else:  # remove
-            my_error("Trying to remove a user %s from a unrelated key %s" % (open_id, key))
-    else:  # the key exist, so upgrade the content
-        open_id_str = data[0][1]
-        open_id_str_dict = json.loads(open_id_str)
-        if add:  # add the open_id into the key
-            my_log("Checking if %s is in the seg %s user list before adding " % (open_id, key), level='DEBUG')
-            # if old_open_id_str.find(open_id) < 0:  # only if the open_id is not in the open_id_str
-            #     new_open_id_str = old_open_id_str + ';' + open_id
-            #     update = True
-            if open_id in open_id_str_dict.keys():
-                open_id_str_dict[open_id] += num
-            else:
-                open_id_str_dict[open_id] = num
-
-        else:  # remove the open_id from the key
-            """
-            index = old_open_id_str.find(open_id)
-            if index < 0:
-                my_error("Trying to remove a user %s from a unrelated key %s" % (open_id, key))
-            elif old_open_id_str == open_id:  # the old_open_id_str is just open_id
-                new_open_id_str = ''
-                update = True
-            elif index == 0:  # the first one but more than one item
-                new_open_id_str = old_open_id_str.replace(open_id + ';', '')
-                update = True
-            else:
-                new_open_id_str = old_open_id_str.replace(';' + open_id, '')
-                update = True
-            """
-            if open_id in open_id_str_dict.keys():
-                del open_id_str_dict[open_id]
-
-        freq = len(open_id_str_dict.keys())
-        if freq == 0:  # the key no longer has any open_id, so delete the item
-            #  we will keep it for a while and delete it later
-            sql = "update key2user set open_id_list='',freq=0,howchanged='delete' where seg='%s'" \
-                    % key
-        else:
-            sql = "update key2user set open_id_list='%s',freq=%s,howchanged='update' where seg='%s'" \
-                    % (json.dumps(open_id_str_dict), freq, key)
+def migrate_key2user_to_posting(db, tbl='key2user'):
+    """
+    Build the posting table from the JSON open_id_list of tbl, the posting table is rebuilt from empty.
+    Return:
+        Int, how many postings are written
+    """
+    posting_tbl = posting_tbl_of(tbl)
+    create_posting_tbl(db, posting_tbl)
+    truncate_tbl(db, posting_tbl)
 
-        data = query_tidb_okr(db, sql)
+    writer = BulkWriter(db, posting_tbl, cols='seg,open_id,num', verb='insert')
+    for seg, open_id_list in get_all_from_tbl_by_cols(db, tbl, ('seg', 'open_id_list')):
+        if not open_id_list:
+            continue
+        _seg = seg.replace('\\', '\\\\').replace("'", "\\'")
+        for open_id, num in json.loads(open_id_list).items():
+            writer.add("('%s','%s',%s)" % (_seg, open_id, num))
+    writer.close()
 
-    cursor.close()
-    return data
+    my_log('migrated %s postings from %s to %s' % (writer.written, tbl, posting_tbl), level='DEBUG')
+    return writer.written
 
 
 def query_tidb_okr(db, query_str):
@@ -233,6 +325,24 @@ def query_tidb_okr(db, query_str):
     return data
 
 
+def query_tidb_okr_or_raise(db, query_str):
+    """
+    Same as query_tidb_okr(), but the error is raised instead of logged, for the checks a rebuild
+    must not take a failure as an answer, e.g. if a shadow table is still there
+    """
+    cursor = db.cursor()
+    try:
+        cursor.execute(query_str)
+        db.commit()
+        return cursor.fetchall()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        cursor.close()
+        my_log("Executed sql %s" % query_str)
+
+
 def get_any_col_from_user(db, tbl, col):
     """
     get any col from users table
@@ -273,26 +383,17 @@ def get_all_changed_keys(db, tbl, howchanged):
     return query_tidb_okr(db, sql)
 
 
-def get_one_from_tbl_by_cols_with_openid(db, tbl, cols, open_id):
-    """
-    Args:
-        cols, tuple contains the cols the caller specified
-        open_id, String, must a be column in the <tbl>
-    Get one tuple from table by the cols with the specified open_id
-
-    """
-    sql = "select %s from %s where open_id='%s'" % (','.join(cols), tbl, open_id)
-    return query_tidb_okr(db, sql)
-
-
-def get_all_from_tbl_by_cols(db, tbl, cols):
+def get_all_from_tbl_by_cols(db, tbl, cols, strict=False):
     """
     Args:
         cols, tuple contains the cols the caller specified
+        strict, Boolean, raise the error instead of returning empty
     Get all tuples from table by the cols
 
     """
     sql = 'select %s from %s' % (','.join(cols), tbl)
+    if strict:
+        return query_tidb_okr_or_raise(db, sql)
     return query_tidb_okr(db, sql)
 
 
@@ -347,8 +448,11 @@ def truncate_tbl(db, tbl):
 
 
 def rn_tbl(db, from_tbl, to_tbl):
+    """
+    Raise the error, the callers swap a table in with it and must not go on as if it is swapped
+    """
     sql = 'rename table %s to %s' % (from_tbl, to_tbl)
-    query_tidb_okr(db, sql)
+    query_tidb_okr_or_raise(db, sql)
 
 
 def drop_tbl(db, tbl):
@@ -364,15 +468,26 @@ def drop_tbl(db, tbl):
     return
 
 
+def tbl_alike_of(tbl):
+    return '%s_like9527' % tbl
+
+
+def tbl_exists(db, tbl):
+    """
+    Raise the error instead of taking it as a missing table
+    """
+    sql = "show tables like '%s'" % tbl
+    return bool(query_tidb_okr_or_raise(db, sql))
+
+
 def create_tbl_alike(db, tbl):
-    tbl_like = '%s_like9527' % tbl
+    tbl_like = tbl_alike_of(tbl)
     drop_tbl(db, tbl_like)  # delete the alike table first
     sql = 'create table %s like %s' % (tbl_like, tbl)
     query_tidb_okr(db, sql)
     return tbl_like
 
 
-
 def value_add(db, tbl, key, col, delta):
     # for debug purpose
     sql = "select %s from %s where name='%s'" % (col, tbl, key)
@@ -388,9 +503,27 @@ def value_add(db, tbl, key, col, delta):
     query_tidb_okr(db, sql)
 
 
-def update_users_by_open_id(db, users, open_id, open_ids):
-    sql = "update %s set %s='%s' where open_id='%s'" % (users,
-                                                        'top_related',
-                                                        open_ids,
-                                                        open_id)
-    data = query_tidb_okr(db, sql)
+def delete_users(db, tbl, open_ids):
+    """
+    Delete the users by open id, 500 users in one statement
+    """
+    open_ids = list(open_ids)
+    for i in range(0, len(open_ids), 500):
+        in_str = ','.join(["'%s'" % open_id for open_id in open_ids[i:i + 500]])
+        sql = "delete from %s where open_id in (%s)" % (tbl, in_str)
+        query_tidb_okr(db, sql)
+
+
+def update_top_related(db, users, pairs):
+    """
+    Args:
+        users: the users table name
+        pairs: List of (open_id, top related open ids delimiter with ;)
+    Update the top_related of many users, 200 users in one statement
+    """
+    for i in range(0, len(pairs), 200):
+        chunk = pairs[i:i + 200]
+        cases = ' '.join(["when '%s' then '%s'" % (open_id, open_ids) for open_id, open_ids in chunk])
+        in_str = ','.join(["'%s'" % open_id for open_id, open_ids in chunk])
+        sql = "update %s set top_related=case open_id %s end where open_id in (%s)" % (users, cases, in_str)
+        query_tidb_okr(db, sql)
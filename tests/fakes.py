@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import json
+import requests
+
+# Stand-ins of the clock and the Feishu server, so the throttling of rate_limiter is checked offline.
+
+
+class FakeClock(object):
+    """
+    A clock for the offline tests, sleep() moves the time forward instead of blocking.
+    Use it as Scheduler(clock=fake.now, sleep=fake.sleep)
+    """
+
+    def __init__(self, start=0.0):
+        self.time = start
+        self.slept = []
+
+    def now(self):
+        return self.time
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.time += seconds
+
+
+class StubSession(object):
+    """
+    Stands for the Feishu server in the offline tests, install it with http_client.set_session().
+    Args:
+        handler: function(method, url, clock_time) returns (status_code, body dict, headers dict)
+        clock: the FakeClock, so the handler can decide by time, e.g. limit by second
+    Each request is recorded in calls as (time, method, url)
+    """
+
+    def __init__(self, handler, clock):
+        self.handler = handler
+        self.clock = clock
+        self.calls = []
+
+    def request(self, method, url, **kwargs):
+        now = self.clock.now()
+        self.calls.append((now, method, url))
+        status_code, body, headers = self.handler(method, url, now)
+        response = requests.Response()
+        response.status_code = status_code
+        response._content = json.dumps(body).encode('utf-8')
+        response.headers.update(headers or {})
+        response.url = url
+        return response
+
+    def close(self):
+        pass
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import http_client
+import rate_limiter
+from fakes import FakeClock, StubSession
+
+OKR_URL = 'https://open.feishu.cn/open-apis/okr/v1/users/ou_1/okrs'
+
+
+@pytest.fixture
+def clock():
+    return FakeClock(start=7.0)
+
+
+def install(clock, handler):
+    stub = StubSession(handler, clock)
+    http_client.set_session(stub)
+    return stub
+
+
+@pytest.fixture(autouse=True)
+def restore_session():
+    yield
+    http_client.set_session(None)
+
+
+def new_scheduler(clock, **kwargs):
+    return rate_limiter.Scheduler(clock=clock.now, sleep=clock.sleep, **kwargs)
+
+
+def send(scheduler, endpoint='okr'):
+    return scheduler.call(endpoint, lambda: http_client.request('GET', OKR_URL))
+
+
+def ok(method, url, now):
+    return 200, {'code': 0, 'data': {}}, {}
+
+
+def test_endpoint_of():
+    assert rate_limiter.endpoint_of(OKR_URL) == 'okr'
+    assert rate_limiter.endpoint_of('https://open.feishu.cn/open-apis/contact/v3/departments/0') == 'department'
+    assert rate_limiter.endpoint_of('https://open.feishu.cn/open-apis/contact/v3/users') == 'contact'
+    assert rate_limiter.endpoint_of('https://example.com/') == 'default'
+
+
+def test_parse_quotas():
+    assert rate_limiter.parse_quotas('contact=50, okr=10,bad,im=x') == {'contact': 50.0, 'okr': 10.0}
+
+
+def test_quota_pacing(clock):
+    stub = install(clock, ok)
+    scheduler = new_scheduler(clock, quotas={'okr': 2})
+
+    for i in range(10):
+        assert send(scheduler).status_code == 200
+
+    times = [t for t, method, url in stub.calls]
+    # the bucket starts full with 2 tokens, then one token every 0.5 second
+    assert times[:2] == [7.0, 7.0]
+    for i in range(2, 10):
+        assert times[i] == pytest.approx(7.0 + (i - 1) * 0.5)
+    assert scheduler.throttled == 0
+
+
+def test_quota_per_endpoint(clock):
+    stub = install(clock, ok)
+    scheduler = new_scheduler(clock, quotas={'okr': 1, 'contact': 100})
+
+    for i in range(3):
+        send(scheduler, 'okr')
+    for i in range(50):
+        send(scheduler, 'contact')
+
+    # the contact calls are not held back by the okr quota
+    assert stub.calls[-1][0] == pytest.approx(9.0)
+
+
+def test_backoff_on_429(clock):
+    def handler(method, url, now):
+        if len(stub.calls) <= 2:
+            return 429, {}, {}
+        return ok(method, url, now)
+
+    stub = install(clock, handler)
+    scheduler = new_scheduler(clock, quotas={'okr': 10}, base_backoff=1.0)
+
+    assert send(scheduler).status_code == 200
+    times = [t for t, method, url in stub.calls]
+    assert len(times) == 3
+    # exponential back off, 1 second then 2 seconds
+    assert times[1] - times[0] == pytest.approx(1.0)
+    assert times[2] - times[1] == pytest.approx(2.0)
+    assert scheduler.throttled == 2
+    assert scheduler.bucket('okr').rate < 10
+
+
+def test_backoff_on_rate_limit_code(clock):
+    def handler(method, url, now):
+        if len(stub.calls) == 1:
+            return 200, {'code': 99991400, 'msg': 'request trigger frequency limit'}, {}
+        return ok(method, url, now)
+
+    stub = install(clock, handler)
+    scheduler = new_scheduler(clock, quotas={'okr': 10}, base_backoff=0.5)
+
+    assert send(scheduler).json()['code'] == 0
+    assert len(stub.calls) == 2
+    assert stub.calls[1][0] - stub.calls[0][0] == pytest.approx(0.5)
+    assert scheduler.throttled == 1
+
+
+def test_retry_after(clock):
+    def handler(method, url, now):
+        if len(stub.calls) in (3, 4):
+            return 429, {}, {'Retry-After': '2'}
+        return ok(method, url, now)
+
+    stub = install(clock, handler)
+    scheduler = new_scheduler(clock, quotas={'okr': 2})
+
+    for i in range(4):
+        assert send(scheduler).status_code == 200
+
+    times = [t for t, method, url in stub.calls]
+    assert len(times) == 6
+    # the server asks for 2 seconds each time, instead of the exponential back off
+    assert times[3] - times[2] == pytest.approx(2.0)
+    assert times[4] - times[3] == pytest.approx(2.0)
+    assert scheduler.throttled == 2
+
+
+def test_retry_after_feishu_header(clock):
+    def handler(method, url, now):
+        if len(stub.calls) == 1:
+            return 200, {'code': 99991400}, {'x-ogw-ratelimit-reset': '3'}
+        return ok(method, url, now)
+
+    stub = install(clock, handler)
+    scheduler = new_scheduler(clock)
+
+    send(scheduler)
+    assert stub.calls[1][0] - stub.calls[0][0] == pytest.approx(3.0)
+
+
+def test_give_up_after_max_retry(clock):
+    stub = install(clock, lambda method, url, now: (429, {}, {}))
+    scheduler = new_scheduler(clock, max_retry=2, base_backoff=1.0, max_backoff=1.5)
+
+    assert send(scheduler).status_code == 429
+    assert len(stub.calls) == 3
+    # the back off is capped by max_backoff
+    assert stub.calls[2][0] - stub.calls[1][0] == pytest.approx(1.5)
+
+
+def test_rate_recovers(clock):
+    bucket = rate_limiter.TokenBucket(8, clock=clock.now)
+    bucket.block(1)
+    assert bucket.rate == 4
+    for i in range(10):
+        bucket.relax()
+    assert bucket.rate == 8
+
+
+def test_token_drift(clock):
+    bucket = rate_limiter.TokenBucket(2, clock=clock.now)
+    bucket.tokens = 0.9999999999999998
+    assert bucket.reserve() == 0.0
+    assert bucket.tokens == 0.0
+    # a positive wait is never too small to move the clock forward
+    bucket.tokens = 1 - 1e-8
+    assert bucket.reserve() >= rate_limiter.MIN_WAIT
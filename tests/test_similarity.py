@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import random
+
+import pytest
+
+import similarity
+
+os.environ.setdefault('SBSCRB_CHK_INTERVAL', '24')  # opokr reads it when imported
+import opokr  # noqa: E402
+
+K = 10
+
+
+def synthetic_segs(seed, users=300, vocab_size=80):
+    """
+    Return:
+        List of the users.segs column. Some users have no segs, and the same segs are repeated,
+        so there are plenty of tied scores
+    """
+    rnd = random.Random(seed)
+    vocab = ['w%d' % i for i in range(vocab_size)]
+    segs_list = []
+    for i in range(users):
+        if rnd.random() < 0.05:
+            segs_list.append(rnd.choice(['', '{}']))
+        elif segs_list and rnd.random() < 0.15:
+            segs_list.append(rnd.choice(segs_list))  # the same segs as an earlier user
+        else:
+            segs = {rnd.choice(vocab): rnd.randint(1, 2) for n in range(rnd.randint(1, 6))}
+            segs_list.append(json.dumps(segs))
+    return segs_list
+
+
+def brute_force_top(segs_list, index, k):
+    """
+    The k most related other users by opokr.segs_relevancy(), the best first, the smaller index first for a tie
+    """
+    scored = []
+    for other in range(len(segs_list)):
+        if other == index:
+            continue
+        rel = opokr.segs_relevancy(segs_list[index], segs_list[other])
+        if rel > 0:
+            scored.append((other, rel))
+    scored.sort(key=lambda item: (-item[1], item[0]))
+    return scored[:k]
+
+
+def assert_same_top(got, expected):
+    assert [other for other, rel in got] == [other for other, rel in expected]
+    assert [rel for other, rel in got] == pytest.approx([rel for other, rel in expected])
+
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_top_related_against_brute_force(seed):
+    segs_list = synthetic_segs(seed)
+    result = list(similarity.iter_top_related(segs_list, K, block_size=64))
+
+    assert [index for index, top in result] == list(range(len(segs_list)))
+    ties = 0
+    for index, top in result:
+        expected = brute_force_top(segs_list, index, K)
+        assert_same_top(top, expected)
+        ties += len(expected) - len(set(rel for other, rel in expected))
+    assert ties > 0  # the data does have tied scores
+
+
+def test_top_related_rows():
+    segs_list = synthetic_segs(4)
+    rows = random.Random(4).sample(range(len(segs_list)), 40)
+
+    result = list(similarity.iter_top_related(segs_list, K, block_size=16, rows=rows))
+
+    assert [index for index, top in result] == rows
+    for index, top in result:
+        assert_same_top(top, brute_force_top(segs_list, index, K))
+
+
+def test_top_related_no_segs():
+    segs_list = ['', '{}', json.dumps({'tidb': 1})]
+    assert list(similarity.iter_top_related(segs_list, K)) == [(0, []), (1, []), (2, [])]
+
+
+def test_topk_tie_breaks_by_index():
+    top = similarity.TopK(2)
+    for index in (5, 3, 9, 1):
+        top.push(1.0, index)
+    top.push(0.5, 0)
+    assert top.items() == [(1, 1.0), (3, 1.0)]
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+import collections
+import os
+import threading
+import time
+from dotenv import load_dotenv, find_dotenv
+
+# The file keeps the users cache of the OkrEx Server in Redis, one hash per user.
+#
+# Each load writes a new version of the keyspace, #user#<version>#<open_id>, in pipelined chunks,
+# then switches the #user#version pointer in one transaction. The readers follow the pointer, so they
+# see either the old users or the new ones, never a half loaded cache. The previous version is kept
+# until the next load, for the readers (e.g. other gunicorn workers) still holding the old pointer.
+#
+# The pages show the users as cards: name, url_id, avatar and the hashcode of the OKR. get_cards() reads
+# the cards of a whole page in one pipelined round trip, with an optional LRU of the cards in front.
+
+# get environmental parameter from .env files
+load_dotenv(find_dotenv())
+
+# how many users are written in one pipeline round trip
+USER_LOAD_CHUNK = int(os.getenv("USER_LOAD_CHUNK") if os.getenv("USER_LOAD_CHUNK") else '1000')
+
+VERSION_KEY = '#user#version'
+NEXT_VERSION_KEY = '#user#next_version'
+VERSIONS_KEY = '#user#versions'  # the kept versions, the newest first
+KEEP_VERSIONS = 2
+
+# the users cache before the versions, one hash per open_id, dropped by the first versioned load
+LEGACY_USER_MATCH = 'ou_*'
+
+VERSION_TTL = 1.0  # seconds a reader trusts the pointer it has read
+
+# how many user cards are kept in the LRU of each process, 0 to read them from redis every time
+USER_CARD_LRU = int(os.getenv("USER_CARD_LRU") if os.getenv("USER_CARD_LRU") else '0')
+
+# the fields of a user shown on the pages, okr_hash leads to the parsed OKR, see okr_objects.py
+CARD_FIELDS = ('name', 'url_id', 'avatar', 'okr_hash')
+
+
+class UserStore(object):
+    """
+    Args:
+        rds: the redis.Redis client, decode_responses=True
+        lru_size: Int, how many user cards are kept in the process
+    """
+
+    def __init__(self, rds, lru_size=USER_CARD_LRU):
+        self.rds = rds
+        self.version = None
+        self.checked = 0.0
+        self.lock = threading.Lock()
+        self.lru_size = lru_size
+        self.cards = collections.OrderedDict()  # (version, open_id) => card, the least recently used first
+
+    def current_version(self):
+        now = time.monotonic()
+        if self.version is None or now - self.checked > VERSION_TTL:
+            version = self.rds.get(VERSION_KEY)
+            with self.lock:
+                self.version = version if version else '0'
+                self.checked = now
+        return self.version
+
+    def key(self, open_id, version=None):
+        """
+        Return:
+            String, the redis key of the user hash in the current version
+        """
+        return '#user#%s#%s' % (version if version else self.current_version(), open_id)
+
+    def blob_key(self, name, version=None):
+        """
+        Return:
+            String, the redis key of a value of the whole version, e.g. the leaders. Open ids never start with @
+        """
+        return self.key('@' + name, version)
+
+    def get_blob(self, name, version=None):
+        return self.rds.get(self.blob_key(name, version))
+
+    def get_fields(self, open_ids, fields, version=None):
+        """
+        Args:
+            open_ids: iterable of open_id
+            fields: tuple of the field names
+        Return:
+            dict, open_id => dict, field => value. One HMGET per user, all in one pipelined round trip.
+            The users not in the cache are left out
+        """
+        open_ids = [open_id for open_id in dict.fromkeys(open_ids) if open_id]
+        if not open_ids:
+            return {}
+
+        version = version if version else self.current_version()
+        pipe = self.rds.pipeline(transaction=False)
+        for open_id in open_ids:
+            pipe.hmget(self.key(open_id, version), fields)
+
+        found = {}
+        for open_id, values in zip(open_ids, pipe.execute()):
+            if any(value is not None for value in values):
+                found[open_id] = dict(zip(fields, values))
+        return found
+
+    def get_cards(self, open_ids):
+        """
+        Args:
+            open_ids: iterable of open_id, e.g. the users on a page
+        Return:
+            dict, open_id => dict of CARD_FIELDS, the users not in the cache are left out.
+            The cards are shared with the LRU, do not change them
+        """
+        open_ids = list(open_ids)
+        if not self.lru_size:
+            return self.get_fields(open_ids, CARD_FIELDS)
+
+        version = self.current_version()
+        cards = {}
+        with self.lock:
+            for open_id in open_ids:
+                card = self.cards.get((version, open_id))
+                if card is not None:
+                    self.cards.move_to_end((version, open_id))
+                    cards[open_id] = card
+
+        fetched = self.get_fields([open_id for open_id in open_ids if open_id not in cards],
+                                  CARD_FIELDS, version)
+        with self.lock:
+            for open_id, card in fetched.items():
+                self.cards[(version, open_id)] = card
+            while len(self.cards) > self.lru_size:
+                self.cards.popitem(last=False)
+        cards.update(fetched)
+        return cards
+
+    def get_card(self, open_id):
+        """
+        Return:
+            dict of CARD_FIELDS, empty if the user is not in the cache
+        """
+        return self.get_cards([open_id]).get(open_id, {})
+
+    def load(self, users, blobs=None):
+        """
+        Args:
+            users: iterable of (open_id, dict of the fields), the whole users cache
+            blobs: dict, name => String, the values of the whole version, see get_blob()
+        Return:
+            Int, how many users are loaded
+        """
+        version = str(self.rds.incr(NEXT_VERSION_KEY))
+
+        count = 0
+        pipe = self.rds.pipeline(transaction=False)
+        for name, value in (blobs or {}).items():
+            pipe.set(self.blob_key(name, version), value)
+        for open_id, fields in users:
+            pipe.hset(self.key(open_id, version),
+                      mapping={field: value if value is not None else '' for field, value in fields.items()})
+            count += 1
+            if count % USER_LOAD_CHUNK == 0:
+                pipe.execute()
+        pipe.execute()
+
+        # switch in one transaction, then drop the versions nobody should read any more
+        pipe = self.rds.pipeline(transaction=True)
+        pipe.set(VERSION_KEY, version)
+        pipe.lpush(VERSIONS_KEY, version)
+        pipe.lrange(VERSIONS_KEY, KEEP_VERSIONS, -1)
+        pipe.ltrim(VERSIONS_KEY, 0, KEEP_VERSIONS - 1)
+        stale = pipe.execute()[2]
+
+        with self.lock:
+            self.version = version
+            self.checked = time.monotonic()
+            self.cards.clear()
+
+        for old in stale:
+            self._drop_version(old)
+        if version == '1':
+            self._drop_keys(LEGACY_USER_MATCH)
+        return count
+
+    def _drop_version(self, version):
+        self._drop_keys('#user#%s#*' % version)
+
+    def _drop_keys(self, match):
+        keys = []
+        for key in self.rds.scan_iter(match=match, count=USER_LOAD_CHUNK):
+            keys.append(key)
+            if len(keys) >= USER_LOAD_CHUNK:
+                self.rds.delete(*keys)
+                keys = []
+        if keys:
+            self.rds.delete(*keys)